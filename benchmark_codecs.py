@@ -0,0 +1,268 @@
+import argparse
+import csv
+import json
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, asdict, fields
+from io import BytesIO
+from multiprocessing import get_all_start_methods, get_context
+from pathlib import Path
+
+import numpy as np
+import psutil
+from PIL import Image, ImageDraw, ImageFont
+from tqdm import tqdm
+
+from image_quality import CODEC_FORMATS, psnr, ssim
+
+IMAGE_KINDS = ('gradient', 'noise', 'text', 'fractal')
+THREADED_CODECS = {'heif', 'avif'}
+# Keys of results that identify a benchmark case, used to match runs against the baseline
+CASE_KEYS = ('image', 'width', 'height', 'codec', 'quality', 'threads')
+# Timing differences below this are treated as noise regardless of the relative tolerance
+MIN_TIME_DELTA_S = 0.005
+
+
+@dataclass(slots=True)
+class BenchmarkResult:
+    image: str
+    width: int
+    height: int
+    codec: str
+    quality: int
+    threads: int
+    encode_s: float
+    decode_s: float
+    peak_rss_mb: float
+    bytes: int
+    bpp: float
+    psnr: float
+    ssim: float
+
+
+def main():
+    args = parse_arguments()
+
+    results = []
+    # Each case runs in a fresh process so peak RSS belongs to that case only and runs do not compete for CPU.
+    # Peak RSS of a forked process starts at the RSS of its parent, so case processes are forked from a small
+    # fork server started before any image is generated (spawn on Windows, where peak RSS is not inherited).
+    start_method = 'forkserver' if 'forkserver' in get_all_start_methods() else 'spawn'
+    with get_context(start_method).Pool(processes=1, maxtasksperchild=1) as pool, \
+            tempfile.TemporaryDirectory() as tmp_dir:
+        cases = []
+        for kind in args.images:
+            for width, height in args.resolutions:
+                # Stored uncompressed on disk, loading it in the case process allocates little beyond the image
+                image_path = Path(tmp_dir) / f'{kind}_{width}x{height}.ppm'
+                generate_image(kind, width, height, args.seed).save(image_path)
+                for codec in args.codecs:
+                    # jpeg and webp encoders in Pillow are single threaded, sweeping threads would only repeat them
+                    threads_list = args.threads if codec in THREADED_CODECS else [1]
+                    for quality in args.qualities:
+                        for threads in threads_list:
+                            cases.append((kind, image_path, codec, quality, threads, args.repeat))
+
+        for result in tqdm(pool.imap(run_case, cases), total=len(cases), desc='Benchmarking codecs'):
+            results.append(result)
+
+    write_results(results, args.output_file)
+    print(f'Results written to {args.output_file}.csv and {args.output_file}.json')
+
+    if args.baseline is not None:
+        regressions = compare_with_baseline(results, load_results(args.baseline), args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        print(f'Found {len(regressions)} regressions against {args.baseline}')
+        if regressions:
+            sys.exit(1)
+
+
+def parse_resolution(value: str) -> tuple[int, int]:
+    try:
+        width, height = (int(v) for v in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Resolution must look like 1920x1080, got: {value}')
+    return width, height
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Benchmark image codecs on locally generated synthetic images. '
+                    'Measures encode/decode time, peak RSS, size, PSNR and SSIM.')
+    parser.add_argument('--output_file', '-o', help='Base path of the CSV/JSON results (no extension).', type=str,
+                        default='benchmark_results')
+    parser.add_argument('--images', '-im', help='Synthetic image kinds to generate.', nargs='+',
+                        choices=IMAGE_KINDS, default=list(IMAGE_KINDS))
+    parser.add_argument('--resolutions', '-r', help='Resolutions as WIDTHxHEIGHT.', nargs='+',
+                        type=parse_resolution, default=[(640, 480), (1920, 1080)])
+    parser.add_argument('--codecs', '-c', help='Codecs to benchmark.', nargs='+', choices=list(CODEC_FORMATS),
+                        default=list(CODEC_FORMATS))
+    parser.add_argument('--qualities', '-q', help='Quality settings [0-100].', nargs='+', type=int,
+                        choices=list(range(101)), default=[50, 75, 90], metavar='QUALITY')
+    parser.add_argument('--threads', '-t', help='Encoder thread counts (heif/avif only).', nargs='+', type=int,
+                        default=[1])
+    parser.add_argument('--repeat', '-n', help='Timed repetitions per case, the fastest is reported.', type=int,
+                        default=3)
+    parser.add_argument('--seed', '-s', help='Seed for the generated images.', type=int, default=0)
+    parser.add_argument('--baseline', '-b', help='Previous results JSON to check for regressions.', type=Path,
+                        default=None)
+    parser.add_argument('--tolerance', '-tol', help='Allowed relative slowdown/size growth vs baseline.',
+                        type=float, default=0.1)
+    return parser.parse_args()
+
+
+def generate_image(kind: str, width: int, height: int, seed: int) -> Image.Image:
+    rng = np.random.default_rng(seed)
+    if kind == 'gradient':
+        x = np.linspace(0, 255, width, dtype=np.float32)[np.newaxis, :]
+        y = np.linspace(0, 255, height, dtype=np.float32)[:, np.newaxis]
+        arr = np.stack(np.broadcast_arrays(x, y, (x + y) / 2), axis=-1)
+        return Image.fromarray(arr.astype(np.uint8), 'RGB')
+    if kind == 'noise':
+        return Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8), 'RGB')
+    if kind == 'text':
+        return generate_text_image(width, height, rng)
+    if kind == 'fractal':
+        return generate_fractal_image(width, height, rng)
+    raise ValueError(f'Unknown image kind: {kind}')
+
+
+def generate_text_image(width: int, height: int, rng: np.random.Generator) -> Image.Image:
+    img = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(img)
+    font_size = max(height // 40, 8)
+    font = ImageFont.load_default(size=font_size)
+    words = ['codec', 'quality', 'heif', 'avif', 'jpeg', 'webp', 'pixel', 'archive', 'frame', 'lorem', 'ipsum']
+    for y in range(0, height, int(font_size * 1.4)):
+        line = ' '.join(rng.choice(words, size=width // font_size))
+        draw.text((font_size // 2, y), line, fill='black', font=font)
+    return img
+
+
+def generate_fractal_image(width: int, height: int, rng: np.random.Generator) -> Image.Image:
+    """1/f^2 spectrum noise per channel, which has statistics close to natural photos"""
+    fy = np.fft.fftfreq(height)[:, np.newaxis]
+    fx = np.fft.rfftfreq(width)[np.newaxis, :]
+    freq = np.sqrt(fx ** 2 + fy ** 2)
+    freq[0, 0] = 1.0
+    amplitude = 1.0 / freq ** 2.0
+    amplitude[0, 0] = 0.0
+
+    channels = []
+    for _ in range(3):
+        phase = rng.uniform(0, 2 * np.pi, freq.shape)
+        channel = np.fft.irfft2(amplitude * np.exp(1j * phase), s=(height, width))
+        channel = (channel - channel.min()) / (np.ptp(channel) or 1.0)
+        channels.append(channel * 255)
+    return Image.fromarray(np.stack(channels, axis=-1).astype(np.uint8), 'RGB')
+
+
+def get_peak_rss_mb() -> float:
+    """Peak resident set size of the current process"""
+    memory_info = psutil.Process().memory_info()
+    if hasattr(memory_info, 'peak_wset'):  # Windows
+        return memory_info.peak_wset / 2 ** 20
+    import resource
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10
+
+
+def encode_params(codec: str, threads: int) -> dict:
+    if codec == 'heif':
+        return {'enc_params': {'x265:pools': str(threads)}}
+    if codec == 'avif':
+        return {'enc_params': {'threads': str(threads)}}
+    return {}
+
+
+def run_case(case: tuple) -> BenchmarkResult:
+    kind, image_path, codec, quality, threads, repeat = case
+    img = Image.open(image_path)
+    img.load()
+    size = img.size
+    save_kwargs = encode_params(codec, threads)
+
+    encode_s = decode_s = float('inf')
+    data = b''
+    for _ in range(repeat):
+        buffer = BytesIO()
+        start = time.perf_counter()
+        img.save(buffer, format=CODEC_FORMATS[codec], quality=quality, **save_kwargs)
+        encode_s = min(encode_s, time.perf_counter() - start)
+        data = buffer.getvalue()
+
+        start = time.perf_counter()
+        with Image.open(BytesIO(data)) as decoded:
+            decoded.load()
+        decode_s = min(decode_s, time.perf_counter() - start)
+    # Read before metrics are computed, they allocate several float copies of the image
+    peak_rss_mb = get_peak_rss_mb()
+
+    with Image.open(BytesIO(data)) as decoded:
+        decoded_arr = np.asarray(decoded.convert('RGB'))
+    original_arr = np.asarray(img)
+
+    return BenchmarkResult(
+        image=kind,
+        width=size[0],
+        height=size[1],
+        codec=codec,
+        quality=quality,
+        threads=threads,
+        encode_s=round(encode_s, 5),
+        decode_s=round(decode_s, 5),
+        peak_rss_mb=round(peak_rss_mb, 1),
+        bytes=len(data),
+        bpp=round(len(data) * 8 / (size[0] * size[1]), 4),
+        psnr=round(psnr(original_arr, decoded_arr), 3),
+        ssim=round(ssim(original_arr, decoded_arr), 5),
+    )
+
+
+def write_results(results: list[BenchmarkResult], output_file: str) -> None:
+    rows = [asdict(result) for result in results]
+    with open(f'{output_file}.json', 'wt', encoding='utf-8') as f:
+        json.dump(rows, f, indent=2, ensure_ascii=False)
+    with open(f'{output_file}.csv', 'wt', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=[field.name for field in fields(BenchmarkResult)])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def load_results(json_path: Path) -> list[BenchmarkResult]:
+    with open(json_path, 'rt', encoding='utf-8') as f:
+        return [BenchmarkResult(**row) for row in json.load(f)]
+
+
+def compare_with_baseline(results: list[BenchmarkResult], baseline: list[BenchmarkResult],
+                          tolerance: float) -> list[str]:
+    """
+    Compare results with the baseline case by case. Times, RSS and size may grow by tolerance (relative),
+    times additionally by MIN_TIME_DELTA_S. PSNR may drop by 0.1 dB and SSIM by 0.001.
+    """
+    baseline_by_case = {tuple(getattr(b, key) for key in CASE_KEYS): b for b in baseline}
+    regressions = []
+    for result in results:
+        case = tuple(getattr(result, key) for key in CASE_KEYS)
+        base = baseline_by_case.get(case)
+        if base is None:
+            continue
+
+        name = '/'.join(str(v) for v in case)
+        for metric in ('encode_s', 'decode_s', 'peak_rss_mb', 'bytes'):
+            old, new = getattr(base, metric), getattr(result, metric)
+            min_delta = MIN_TIME_DELTA_S if metric.endswith('_s') else 0
+            if new > old * (1 + tolerance) and new - old > min_delta:
+                regressions.append(f'{name}: {metric} {old} -> {new}')
+        for metric, allowed_drop in (('psnr', 0.1), ('ssim', 0.001)):
+            old, new = getattr(base, metric), getattr(result, metric)
+            if new < old - allowed_drop:
+                regressions.append(f'{name}: {metric} {old} -> {new}')
+    return regressions
+
+
+if __name__ == '__main__':
+    main()
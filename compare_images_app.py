@@ -2,6 +2,7 @@ import argparse
 import json
 import os
 import shutil
+import subprocess
 from pathlib import Path
 from tkinter import messagebox
 
@@ -9,10 +10,20 @@ import customtkinter as ctk
 from PIL import Image, ImageTk
 from pillow_heif import register_heif_opener, register_avif_opener
 
+from convert_video import is_video_file
+from find_similar_videos import video_preview
+
 register_heif_opener()
 register_avif_opener()
 
 
+def open_preview(path: Path) -> Image.Image:
+    """Pairs from find_similar_videos.py are shown as a keyframe of each video"""
+    if is_video_file(path):
+        return video_preview(path)
+    return Image.open(path)
+
+
 class ImageComparerApp:
     def __init__(self, master: ctk.CTk, json_file: str, output_json: str, moved_images_dir: str) -> None:
         self.master: ctk.CTk = master
@@ -110,15 +121,15 @@ class ImageComparerApp:
         img2_size: tuple[int, int] = pair['img2_size']
 
         try:
-            img1 = Image.open(img1_path)
-        except (FileNotFoundError, OSError) as e:
+            img1 = open_preview(img1_path)
+        except (FileNotFoundError, OSError, subprocess.CalledProcessError) as e:
             print(f"Warning: Could not load {img1_path}: {e}")
             self.next_pair()
             return
 
         try:
-            img2 = Image.open(img2_path)
-        except (FileNotFoundError, OSError) as e:
+            img2 = open_preview(img2_path)
+        except (FileNotFoundError, OSError, subprocess.CalledProcessError) as e:
             print(f"Warning: Could not load {img2_path}: {e}")
             self.next_pair()
             return
@@ -131,8 +142,8 @@ class ImageComparerApp:
         img1_resolution = img1_size[0] * img1_size[1]
         img2_resolution = img2_size[0] * img2_size[1]
 
-        # Codec priority (AVIF > HEIF > PNG > Others)
-        codec_priority = {'avif': 3, 'heif': 2, 'png': 1}
+        # Codec priority (AVIF > HEIF > PNG > Others, AV1 > HEVC > H.264 > Others for videos)
+        codec_priority = {'avif': 3, 'heif': 2, 'png': 1, 'av1': 3, 'hevc': 2, 'h264': 1}
         img1_codec_score = codec_priority.get(img1_codec.lower(), 0)
         img2_codec_score = codec_priority.get(img2_codec.lower(), 0)
 
@@ -1,12 +1,28 @@
 import argparse
+import json
+import queue
 import shutil
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from io import BytesIO
+from multiprocessing import cpu_count, get_context
 from pathlib import Path
+from typing import Any
 
 import psutil
 from PIL import Image
 from pillow_heif import register_heif_opener, register_avif_opener
 from tqdm import tqdm
 
+from file_metrics import FileRecord, MetricsRecorder, add_metrics_arguments, worker_profiling
+from image_quality import encode_for_target, encode_to_buffer
+from memory_budget import MemoryAdmission, add_memory_budget_argument, estimate_convert_memory, \
+    memory_budget_bytes, read_image_header
+
 register_heif_opener()
 register_avif_opener()
 
@@ -28,26 +44,262 @@ def convert_images_in_dir(args: argparse.Namespace):
     dst_path: Path = args.output_dir
     dst_path.mkdir(parents=True, exist_ok=True)
 
-    files = list(src_dir.rglob('*'))
+    metric, _ = get_quality_target(args)
+
+    with MetricsRecorder.from_args('convert_images', args) as recorder:
+        with recorder.stage('scan'):
+            files = list(src_dir.rglob('*'))
+
+        pipeline = ConversionPipeline(src_dir, dst_path, args, recorder)
+        pipeline.run(files)
+
+    if metric is not None:
+        report_path = dst_path / 'quality_report.json'
+        with open(report_path, 'wt', encoding='utf-8') as f:
+            json.dump(pipeline.quality_report, f, indent=2, ensure_ascii=False)
+        print(f'Chosen qualities saved to {report_path}')
+        missed = [path for path, entry in pipeline.quality_report.items() if not entry['target_met']]
+        if missed:
+            print(f'Warning: {len(missed)} files did not reach the target even at quality 100 '
+                  f'("target_met": false in the report)')
+
+
+class ConversionPipeline:
+    """
+    Overlaps disk I/O with encoding. Reader threads prefetch file bytes, a process pool decodes and encodes
+    from those in-memory buffers and writer threads store the results:
+
+        read threads -> (at most read_queue buffers) -> process pool -> write_queue -> write threads
+
+    The main thread only routes events between the stages and starts encodes allowed by the memory budget.
+    """
+
+    def __init__(self, src_dir: Path, dst_path: Path, args: argparse.Namespace, recorder: MetricsRecorder):
+        self.src_dir = src_dir
+        self.dst_path = dst_path
+        self.args = args
+        self.recorder = recorder
+        self.targeted = get_quality_target(args)[0] is not None
+        self.quality_report = {}
+        self.busy_seconds = defaultdict(float)
+        self._events = queue.Queue()
+        self._paths = queue.Queue()
+        self._read_slots = threading.Semaphore(args.read_queue)
+        self._write_queue = queue.Queue(maxsize=args.write_queue)
+
+    def run(self, files: list[Path]) -> None:
+        for img_path in files:
+            self._paths.put(img_path)
 
-    for img_path in tqdm(files, total=len(files)):
-        if not img_path.is_file() or not is_image(img_path):
+        admission = MemoryAdmission(memory_budget_bytes(self.args), self.args.workers)
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self._reader, daemon=True) for _ in range(self.args.read_threads)]
+        threads += [threading.Thread(target=self._writer, daemon=True) for _ in range(self.args.write_threads)]
+        for thread in threads:
+            thread.start()
+
+        executor = new_encode_executor(self.args.workers)
+        with tqdm(total=len(files)) as pbar:
+            remaining = len(files)
+            while remaining:
+                kind, record, payload = self._events.get()
+                if kind == 'read':
+                    data, cost = payload
+                    admission.add((record, data), cost)
+                elif kind == 'copy':
+                    self._read_slots.release()
+                    self._write_queue.put((record, payload))
+                elif kind == 'encoded' and not record.error:
+                    admission.release(payload[1])
+                    self._write_queue.put((record, payload[0]))
+                else:  # 'skipped' before encoding, failed encode or 'written' (successfully or not)
+                    if kind == 'skipped':
+                        self._read_slots.release()
+                    elif kind == 'encoded':
+                        admission.release(payload[1])
+                    self._finish(record)
+                    remaining -= 1
+                    pbar.update(1)
+
+                while (admitted := admission.next_admitted()) is not None:
+                    (record, data), cost = admitted
+                    self._read_slots.release()
+                    record.profiler = None  # Workers profile their stages with their own profiler
+                    job = (record, data, self.args, self.recorder.worker_stats_dir)
+                    try:
+                        future = executor.submit(encode_image_job, job)
+                    except BrokenProcessPool:  # A worker died, jobs submitted later get a new pool
+                        executor.shutdown(wait=False)
+                        executor = new_encode_executor(self.args.workers)
+                        future = executor.submit(encode_image_job, job)
+                    future.add_done_callback(partial(self._encoded, record, cost))
+        executor.shutdown()
+
+        for _ in range(self.args.write_threads):
+            self._write_queue.put(None)
+        self.report_utilisation(time.perf_counter() - start)
+
+    def _encoded(self, record: FileRecord, cost: int, future: Future) -> None:
+        try:
+            record, encoded = future.result()
+        except Exception as e:
+            # The result failed to pickle, or a worker was killed (e.g. by the OOM killer) which fails every job
+            # running in the pool at that time with BrokenProcessPool
+            print(f'Failed to process {record.path}: {e}')
+            record.error = f'{type(e).__name__}: {e}'
+            encoded = None
+        self._events.put(('encoded', record, (encoded, cost)))
+
+    def _reader(self) -> None:
+        while True:
+            try:
+                img_path = self._paths.get_nowait()
+            except queue.Empty:
+                return
+            self._read_slots.acquire()
+            record = FileRecord(path=str(img_path), profiler=self.recorder.profiler)
+            try:
+                self._events.put(self._read(img_path, record))
+            except Exception as e:
+                print(f'Failed to process {img_path}: {e}')
+                record.error = f'{type(e).__name__}: {e}'
+                self._events.put(('skipped', record, None))
+
+    def _read(self, img_path: Path, record: FileRecord) -> tuple[str, FileRecord, Any]:
+        if not img_path.is_file():
+            record.skipped = True
+            return 'skipped', record, None
+
+        # Only the header is read here, so videos and other large non-image files are never loaded into memory
+        with record.stage('sniff'):
+            header = read_image_header(img_path)
+            # Files already in the target codec are copied as they are, so verify them fully here
+            is_copy = header is not None and img_path.suffix.lower() == f'.{self.args.codec}'
+            if is_copy and not is_image(img_path):
+                header = None
+        if header is None:
             print(f'Skipping file: {img_path}')
-            continue
+            record.skipped = True
+            return 'skipped', record, None
+        if is_copy:
+            record.bytes_in = img_path.stat().st_size
+            return 'copy', record, None
 
-        relative_path = img_path.relative_to(src_dir)
-        save_path = dst_path / relative_path.with_suffix(f'.{args.codec}')
+        with record.stage('read'):
+            data = img_path.read_bytes()
+        record.bytes_in = len(data)
+        # The buffer is held until the encode finishes, so it counts against the memory budget too
+        cost = estimate_convert_memory(header, self.args.codec, self.targeted) + len(data)
+        return 'read', record, (data, cost)
 
-        if img_path.suffix.lower() == f'.{args.codec}':
-            shutil.copy2(img_path, save_path)
-            print(f'Copied file: {img_path} to {save_path}')
-            continue
+    def _writer(self) -> None:
+        while (item := self._write_queue.get()) is not None:
+            record, data = item
+            record.profiler = self.recorder.profiler
+            img_path = Path(record.path)
+            try:
+                save_path = save_path_for(img_path, self.src_dir, self.dst_path, self.args.codec)
+                save_path.parent.mkdir(parents=True, exist_ok=True)
+                if data is None:  # Already in the target codec
+                    with record.stage('copy'):
+                        shutil.copy2(img_path, save_path)
+                    record.bytes_out = record.bytes_in
+                else:
+                    with record.stage('write'):
+                        save_path.write_bytes(data)
+                        shutil.copystat(img_path, save_path, follow_symlinks=True)
+                    record.bytes_out = len(data)
+            except Exception as e:
+                print(f'Failed to process {img_path}: {e}')
+                record.error = f'{type(e).__name__}: {e}'
+            self._events.put(('written', record, None))
+
+    def _finish(self, record: FileRecord) -> None:
+        for name, seconds in record.stages.items():
+            self.busy_seconds[name] += seconds
+        if 'quality' in record.extra:
+            self.quality_report[Path(record.path).relative_to(self.src_dir).as_posix()] = dict(record.extra)
+        self.recorder.add(record)
 
-        save_path.parent.mkdir(parents=True, exist_ok=True)
+    def report_utilisation(self, wall_seconds: float) -> None:
+        """Busy time of each stage relative to the time all its threads/processes were available"""
+        stages = (
+            ('read', self.busy_seconds['read'] + self.busy_seconds['sniff'], self.args.read_threads),
+            ('decode+encode', self.busy_seconds['decode'] + self.busy_seconds['encode'], self.args.workers),
+            ('write', self.busy_seconds['write'] + self.busy_seconds['copy'], self.args.write_threads),
+        )
+        for name, busy, parallelism in stages:
+            utilisation = busy / (wall_seconds * parallelism) if wall_seconds else 0.0
+            print(f'{name}: busy {busy:.1f} s, utilisation {utilisation:.0%} of {parallelism}')
 
-        with Image.open(img_path) as img:
-            img.save(save_path, compression=args.codec, quality=args.quality)
+
+def new_encode_executor(workers: int) -> ProcessPoolExecutor:
+    # Workers are started while reader and writer threads run, forking then could copy locks they hold
+    return ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'))
+
+
+def encode_image_job(job: tuple[FileRecord, bytes, argparse.Namespace, Path | None]) -> tuple[FileRecord, bytes | None]:
+    """Runs in a worker process, returns the record (timings, errors) and the encoded image"""
+    record, data, args, profile_stats_dir = job
+    try:
+        with worker_profiling(record, profile_stats_dir):
+            return record, encode_image(data, args, record)
+    except Exception as e:
+        print(f'Failed to process {record.path}: {e}')
+        record.error = f'{type(e).__name__}: {e}'
+        return record, None
+
+
+def encode_image(data: bytes, args: argparse.Namespace, record: FileRecord) -> bytes:
+    """Decode an image from memory and encode it. In target mode chosen quality goes to record.extra"""
+    metric, target = get_quality_target(args)
+    # BytesIO shares the bytes object until it is written to, so the buffer is not copied for decoding
+    with Image.open(BytesIO(data)) as img:
+        with record.stage('decode'):
+            img.load()
+        with record.stage('encode'):
+            if metric is None:
+                return encode_to_buffer(img, args.codec, args.quality)
+            encoded, quality, value = encode_for_target(img, args.codec, metric, target, args.probe_size)
+            record.extra.update({'quality': quality, metric: round(value, 4), 'target_met': value >= target})
+            if value < target:
+                print(f'Warning: {record.path} reaches only {metric} {value:.4f} at quality {quality}, '
+                      f'target {target} not met')
+            return encoded
+
+
+def save_path_for(img_path: Path, src_dir: Path, dst_path: Path, codec: str) -> Path:
+    return dst_path / img_path.relative_to(src_dir).with_suffix(f'.{codec}')
+
+
+def convert_image(img_path: Path, src_dir: Path, dst_path: Path, args: argparse.Namespace, record: FileRecord):
+    """Convert one image to the mirrored path under dst_path without the pipeline, used for single new files"""
+    record.bytes_in = img_path.stat().st_size
+    save_path = save_path_for(img_path, src_dir, dst_path, args.codec)
+    save_path.parent.mkdir(parents=True, exist_ok=True)
+
+    if img_path.suffix.lower() == f'.{args.codec}':
+        with record.stage('copy'):
+            shutil.copy2(img_path, save_path)
+        record.bytes_out = record.bytes_in
+        print(f'Copied file: {img_path} to {save_path}')
+        return
+
+    with record.stage('read'):
+        data = img_path.read_bytes()
+    encoded = encode_image(data, args, record)
+    with record.stage('write'):
+        save_path.write_bytes(encoded)
         shutil.copystat(img_path, save_path, follow_symlinks=True)
+    record.bytes_out = len(encoded)
+
+
+def get_quality_target(args: argparse.Namespace) -> tuple[str | None, float | None]:
+    if args.target_psnr is not None:
+        return 'psnr', args.target_psnr
+    if args.target_ssim is not None:
+        return 'ssim', args.target_ssim
+    return None, None
 
 
 def main():
@@ -62,6 +314,29 @@ def main():
     parser.add_argument(
         '--quality', '-q', help='Codec quality setting [0-100]', default=50, type=int, choices=list(range(101))
     )
+    target_group = parser.add_mutually_exclusive_group()
+    target_group.add_argument(
+        '--target_psnr', '-tp', help='Pick the lowest quality reaching this PSNR [dB] instead of --quality',
+        default=None, type=float
+    )
+    target_group.add_argument(
+        '--target_ssim', '-ts', help='Pick the lowest quality reaching this SSIM [0-1] instead of --quality',
+        default=None, type=float
+    )
+    parser.add_argument(
+        '--probe_size', '-ps', help='Longest side of the downscaled image used to search quality', default=512,
+        type=int
+    )
+    parser.add_argument('--workers', '-w', help='Number of decode/encode worker processes', default=cpu_count(),
+                        type=int)
+    parser.add_argument('--read_threads', '-rt', help='Threads prefetching source files', default=4, type=int)
+    parser.add_argument('--write_threads', '-wt', help='Threads writing converted files', default=2, type=int)
+    parser.add_argument('--read_queue', '-rq', help='Maximum number of prefetched files waiting for a worker',
+                        default=2 * cpu_count(), type=int)
+    parser.add_argument('--write_queue', '-wq', help='Maximum number of encoded files waiting to be written',
+                        default=2 * cpu_count(), type=int)
+    add_memory_budget_argument(parser)
+    add_metrics_arguments(parser)
     args = parser.parse_args()
     convert_images_in_dir(args)
 
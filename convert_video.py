@@ -1,11 +1,25 @@
 import argparse
+import json
+import os
+import shlex
 import shutil
 import subprocess
+from datetime import datetime, timezone
 from pathlib import Path
 
 import filetype
 from tqdm import tqdm
 
+from file_metrics import FileRecord, MetricsRecorder, add_metrics_arguments
+
+VIDEO_CODEC = 'hevc'
+VIDEO_QUALITY = 25
+VIDEO_PRESET = 'veryslow'
+AUDIO_ARGS = ['-c:a', 'aac', '-b:a', '64k']
+# Copy container tags (creation time, location, device) from input 0. Tags of each mapped stream (rotation,
+# language) are copied by ffmpeg by default, explicit per-stream maps fail on sources without e.g. an audio stream
+METADATA_ARGS = ['-movflags', 'use_metadata_tags', '-map_metadata', '0']
+
 
 def is_video_file(file_path: Path) -> bool:
     # Detect the file type using the filetype library
@@ -16,51 +30,105 @@ def is_video_file(file_path: Path) -> bool:
     return 'video/' in kind.mime
 
 
-def convert_videos_in_dir(args):
-    src_path = args.src_path
-    dst_path = args.dst_path
+def video_encode_args(quality: int = VIDEO_QUALITY, preset: str = VIDEO_PRESET, codec: str = VIDEO_CODEC) -> list[str]:
+    return ['-c:v', codec, '-global_quality', str(quality), '-preset', preset, '-fps_mode', 'vfr']
 
-    assert src_path.exists(), f'src_path does not exist: {src_path.resolve()}'
-    assert src_path.is_dir(), f'src_path is not a directory: {src_path.resolve()}'
 
-    dst_path.mkdir(parents=True, exist_ok=True)
+def probe_tags(file: Path) -> dict[str, str]:
+    """Container level tags of a media file as reported by ffprobe"""
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-show_entries', 'format_tags', '-of', 'json', str(file)],
+        capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout).get('format', {}).get('tags', {})
 
-    # Use rglob to find all files in all subdirectories
-    files = list(src_path.rglob('*'))
 
-    for file in tqdm(files, total=len(files)):
-        if not file.is_file() or not is_video_file(file):
-            print(f'Skipping file: {file}')
-            continue
+def creation_time_args(file: Path, tags: dict[str, str]) -> list[str]:
+    """Formats such as MTS or AVI carry no creation_time tag, use the file modification time for them"""
+    if 'creation_time' in tags:
+        return []
+    mtime = datetime.fromtimestamp(file.stat().st_mtime, tz=timezone.utc)
+    return ['-metadata', f"creation_time={mtime.strftime('%Y-%m-%dT%H:%M:%S.%fZ')}"]
 
-        # Compute the relative path of the video with respect to the source directory
-        relative_path = file.relative_to(src_path)
-        dst_file = dst_path / relative_path.with_suffix('.mp4')
-        dst_file.parent.mkdir(parents=True, exist_ok=True)
 
-        try:
-            call_str = (
-                f'ffmpeg -i "{file.resolve()}" '
-                f'-c:v hevc -global_quality 25 -preset veryslow -fps_mode vfr '
-                f'-c:a aac -b:a 64k '
-                f'-movflags use_metadata_tags -map_metadata 0 "{dst_file.resolve()}" -y'
-            )
+def temp_path_for(dst_file: Path) -> Path:
+    """Hidden file next to the destination, so the final rename stays on one filesystem and is atomic"""
+    return dst_file.with_name(f'.{dst_file.stem}.tmp{dst_file.suffix}')
 
-            print(f"Executing: {call_str}")
-            result = subprocess.run(call_str, shell=False, capture_output=True, text=True)
-            print(result.stdout)
-            print(result.stderr)
 
-            if result.stderr or result.returncode != 0:
-                print(f"Error processing file: {file}")
-                exit(-1)
+def convert_videos_in_dir(args):
+    src_path = args.src_path
+    dst_path = args.dst_path
 
-            shutil.copystat(file, dst_file, follow_symlinks=True)
-            dst_file.unlink(missing_ok=True)
-            shutil.move(dst_file, dst_file)
+    assert src_path.exists(), f'src_path does not exist: {src_path.resolve()}'
+    assert src_path.is_dir(), f'src_path is not a directory: {src_path.resolve()}'
+
+    dst_path.mkdir(parents=True, exist_ok=True)
 
-        except Exception as e:
-            print(f"Failed to process {file}: {e}")
+    with MetricsRecorder.from_args('convert_video', args) as recorder:
+        # Use rglob to find all files in all subdirectories
+        with recorder.stage('scan'):
+            files = list(src_path.rglob('*'))
+
+        for file in tqdm(files, total=len(files)):
+            with recorder.file(file) as record:
+                if not convert_video(file, src_path, dst_path, args, record):
+                    exit(-1)
+
+
+def convert_video(file: Path, src_path: Path, dst_path: Path, args, record: FileRecord) -> bool:
+    """Convert one video to the mirrored .mp4 path under dst_path. Returns False when ffmpeg reported an error"""
+    with record.stage('sniff'):
+        is_video = file.is_file() and is_video_file(file)
+    if not is_video:
+        print(f'Skipping file: {file}')
+        record.skipped = True
+        return True
+
+    # Compute the relative path of the video with respect to the source directory
+    relative_path = file.relative_to(src_path)
+    dst_file = dst_path / relative_path.with_suffix('.mp4')
+    dst_file.parent.mkdir(parents=True, exist_ok=True)
+    record.bytes_in = file.stat().st_size
+
+    tmp_file = temp_path_for(dst_file)
+
+    try:
+        with record.stage('probe'):
+            tags = probe_tags(file)
+
+        # Rotation is applied to the decoded frames by ffmpeg, so the output is stored upright
+        call_args = [
+            'ffmpeg', '-v', 'error', '-i', str(file.resolve()),
+            *video_encode_args(args.quality, args.preset),
+            *AUDIO_ARGS,
+            *METADATA_ARGS,
+            *creation_time_args(file, tags),
+            str(tmp_file.resolve()), '-y'
+        ]
+
+        print(f"Executing: {shlex.join(call_args)}")
+        with record.stage('encode'):
+            result = subprocess.run(call_args, shell=False, capture_output=True, text=True)
+        print(result.stdout)
+        print(result.stderr)
+
+        if result.stderr or result.returncode != 0:
+            print(f"Error processing file: {file}")
+            record.error = f'ffmpeg exited with {result.returncode}'
+            tmp_file.unlink(missing_ok=True)
+            return False
+
+        with record.stage('copy'):
+            shutil.copystat(file, tmp_file, follow_symlinks=True)
+            os.replace(tmp_file, dst_file)
+        record.bytes_out = dst_file.stat().st_size
+
+    except Exception as e:
+        print(f"Failed to process {file}: {e}")
+        record.error = f'{type(e).__name__}: {e}'
+        tmp_file.unlink(missing_ok=True)
+    return True
 
 
 def main():
@@ -73,6 +141,11 @@ def main():
                         help='Path to the source directory containing video files.')
     parser.add_argument('--dst_path', '-d', type=Path, required=True,
                         help='Path to the destination directory for output files.')
+    parser.add_argument('--quality', '-q', type=int, default=VIDEO_QUALITY,
+                        help=f'Value of ffmpeg -global_quality (default: {VIDEO_QUALITY}).')
+    parser.add_argument('--preset', '-p', type=str, default=VIDEO_PRESET,
+                        help=f'Encoder preset (default: {VIDEO_PRESET}).')
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
     convert_videos_in_dir(args)
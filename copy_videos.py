@@ -6,6 +6,8 @@ from pathlib import Path
 import filetype
 from tqdm import tqdm
 
+from file_metrics import MetricsRecorder, add_metrics_arguments
+
 
 def is_video_file(file_path: Path) -> bool:
     # Detect the file type using the filetype library
@@ -22,6 +24,7 @@ def main():
                         help='Path to the source directory containing video files.')
     parser.add_argument('--dst_path', '-d', type=Path, required=True,
                         help='Path to the destination directory for output files.')
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
 
@@ -29,27 +32,36 @@ def main():
     assert args.src_path.is_dir(), f'src_path is not a directory: {args.src_path.resolve()}'
 
     args.dst_path.mkdir(parents=True, exist_ok=True)
-    files = list(args.src_path.rglob('*'))
     file_mapping = {}
 
-    for file in tqdm(files, total=len(files)):
-        if not file.is_file() or not is_video_file(file):
-            print(f'Skipping file: {file}')
-            continue
-
-        # Create destination path without subdirectories
-        dst_file_path = args.dst_path / file.name
-
-        # Prevent overwriting by appending a counter if necessary
-        base_name = dst_file_path.stem
-        extension = dst_file_path.suffix
-        counter = 1
-        while dst_file_path.exists():
-            dst_file_path = args.dst_path / f"{base_name}_{counter}{extension}"
-            counter += 1
-
-        shutil.copy2(file, dst_file_path)
-        file_mapping[str(dst_file_path)] = str(file)
+    with MetricsRecorder.from_args('copy_videos', args) as recorder:
+        with recorder.stage('scan'):
+            files = list(args.src_path.rglob('*'))
+
+        for file in tqdm(files, total=len(files)):
+            with recorder.file(file) as record:
+                with record.stage('sniff'):
+                    is_video = file.is_file() and is_video_file(file)
+                if not is_video:
+                    print(f'Skipping file: {file}')
+                    record.skipped = True
+                    continue
+
+                # Create destination path without subdirectories
+                dst_file_path = args.dst_path / file.name
+
+                # Prevent overwriting by appending a counter if necessary
+                base_name = dst_file_path.stem
+                extension = dst_file_path.suffix
+                counter = 1
+                while dst_file_path.exists():
+                    dst_file_path = args.dst_path / f"{base_name}_{counter}{extension}"
+                    counter += 1
+
+                with record.stage('copy'):
+                    shutil.copy2(file, dst_file_path)
+                record.bytes_in = record.bytes_out = dst_file_path.stat().st_size
+                file_mapping[str(dst_file_path)] = str(file)
 
     # Save the mapping to a JSON file
     mapping_file_path = args.dst_path / 'file_mapping.json'
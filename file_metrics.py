@@ -0,0 +1,261 @@
+import argparse
+import cProfile
+import io
+import json
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+
+METRIC_PREFIX = 'media_pipeline'
+
+
+class StageProfiler:
+    """cProfile and tracemalloc wrapped around selected stages, enabled with --profile"""
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self._lock = threading.Lock()
+        tracemalloc.start()
+
+    @contextmanager
+    def stage(self, peak_alloc_bytes: dict[str, int], name: str):
+        # cProfile can profile only one stage at a time, other threads run their stages unprofiled
+        if not self._lock.acquire(blocking=False):
+            yield
+            return
+        try:
+            tracemalloc.reset_peak()
+            self.profile.enable()
+            try:
+                yield
+            finally:
+                self.profile.disable()
+                peak_alloc_bytes[name] = max(peak_alloc_bytes.get(name, 0), tracemalloc.get_traced_memory()[1])
+        finally:
+            self._lock.release()
+
+    def dump(self, stats_path: Path, worker_stats_dir: Path | None = None, top: int = 20) -> None:
+        """Save and print the stats, merged with stats written by worker processes to worker_stats_dir"""
+        tracemalloc.stop()
+        # pstats cannot be built from a profiler which never ran, e.g. a watcher stopped before any file arrived
+        sources = [self.profile] if self.profile.getstats() else []
+        if worker_stats_dir is not None:
+            sources += [str(worker_stats) for worker_stats in sorted(worker_stats_dir.glob('*.prof'))]
+        if not sources:
+            print('No stages were profiled')
+            return
+        stream = io.StringIO()
+        stats = pstats.Stats(*sources, stream=stream)
+        stats.dump_stats(stats_path)
+        stats.sort_stats('cumulative').print_stats(top)
+        print(stream.getvalue())
+        print(f'Profile saved to {stats_path}')
+
+
+@dataclass(slots=True)
+class FileRecord:
+    """Stage timings and sizes of one processed file, picklable so worker processes can return it"""
+    path: str
+    stages: dict[str, float] = field(default_factory=dict)
+    bytes_in: int = 0
+    bytes_out: int = 0
+    error: str | None = None
+    skipped: bool = False
+    extra: dict = field(default_factory=dict)
+    peak_alloc_bytes: dict[str, int] = field(default_factory=dict)
+    profiler: StageProfiler | None = field(default=None, repr=False, compare=False)
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            if self.profiler is None:
+                yield
+            else:
+                with self.profiler.stage(self.peak_alloc_bytes, name):
+                    yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    @property
+    def status(self) -> str:
+        if self.error:
+            return 'error'
+        return 'skipped' if self.skipped else 'ok'
+
+    @property
+    def compression_ratio(self) -> float | None:
+        return self.bytes_in / self.bytes_out if self.bytes_in and self.bytes_out else None
+
+    def to_json(self, tool: str) -> dict:
+        data = asdict(self)
+        del data['profiler']
+        if not data['peak_alloc_bytes']:
+            del data['peak_alloc_bytes']
+        data['stages'] = {name: round(seconds, 6) for name, seconds in self.stages.items()}
+        return {'ts': round(time.time(), 3), 'tool': tool, **data, 'compression_ratio': self.compression_ratio}
+
+
+_worker_profiler: StageProfiler | None = None
+
+
+@contextmanager
+def worker_profiling(record: FileRecord, stats_dir: Path | None):
+    """
+    Profile stages of a record processed in a worker process, stats_dir is MetricsRecorder.worker_stats_dir.
+    Each worker keeps one profiler and rewrites its accumulated stats after every file, the recorder merges them.
+    """
+    global _worker_profiler
+    if stats_dir is None:
+        yield
+        return
+    if _worker_profiler is None:
+        _worker_profiler = StageProfiler()
+    record.profiler = _worker_profiler
+    try:
+        yield
+    finally:
+        record.profiler = None  # The record is sent back to the main process, the profiler cannot be pickled
+        _worker_profiler.profile.dump_stats(stats_dir / f'worker_{os.getpid()}.prof')
+
+
+class MetricsRecorder:
+    """
+    Collects FileRecords of a tool run. Each record is appended to a JSON Lines file as soon as it is added,
+    totals are written to a Prometheus textfile (node_exporter textfile collector format) on flush() and close.
+    """
+
+    def __init__(self, tool: str, jsonl_path: Path | None = None, prometheus_path: Path | None = None,
+                 profile: bool = False):
+        self.tool = tool
+        self.prometheus_path = prometheus_path
+        self.profiler = StageProfiler() if profile else None
+        # Passed to worker_profiling() by tools running stages in worker processes
+        self.worker_stats_dir = Path(tempfile.mkdtemp(prefix=f'{tool}_profile_')) if profile else None
+        self._jsonl = open(jsonl_path, 'at', encoding='utf-8') if jsonl_path is not None else None
+        self._lock = threading.Lock()
+        self._files = defaultdict(int)
+        self._stage_seconds = defaultdict(float)
+        self._bytes_in = 0
+        self._bytes_out = 0
+
+    @classmethod
+    def from_args(cls, tool: str, args: argparse.Namespace) -> 'MetricsRecorder':
+        return cls(tool, args.metrics_file, args.prometheus_file, args.profile)
+
+    def __enter__(self) -> 'MetricsRecorder':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    @contextmanager
+    def file(self, path: Path | str):
+        """Record the block as processing of one file, exceptions are stored as the record error and re-raised"""
+        record = FileRecord(path=str(path), profiler=self.profiler)
+        try:
+            yield record
+        except Exception as e:
+            record.error = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            self.add(record)
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time a stage of the whole run which does not belong to any single file, e.g. scanning a directory"""
+        peak_alloc_bytes = {}
+        start = time.perf_counter()
+        try:
+            if self.profiler is None:
+                yield
+            else:
+                with self.profiler.stage(peak_alloc_bytes, name):
+                    yield
+        finally:
+            seconds = time.perf_counter() - start
+            data = {'ts': round(time.time(), 3), 'tool': self.tool, 'stage': name, 'seconds': round(seconds, 6)}
+            if peak_alloc_bytes:
+                data['peak_alloc_bytes'] = peak_alloc_bytes[name]
+            with self._lock:
+                self._stage_seconds[name] += seconds
+                self._write_jsonl(data)
+
+    def add(self, record: FileRecord) -> None:
+        record.profiler = None
+        with self._lock:
+            self._files[record.status] += 1
+            for name, seconds in record.stages.items():
+                self._stage_seconds[name] += seconds
+            self._bytes_in += record.bytes_in
+            self._bytes_out += record.bytes_out
+            self._write_jsonl(record.to_json(self.tool))
+
+    def _write_jsonl(self, data: dict) -> None:
+        if self._jsonl is not None:
+            self._jsonl.write(json.dumps(data, ensure_ascii=False) + '\n')
+            self._jsonl.flush()
+
+    def flush(self) -> None:
+        """Write current totals to the Prometheus textfile, for long-running tools between bursts of work"""
+        if self.prometheus_path is not None:
+            with self._lock:
+                self.write_prometheus(self.prometheus_path)
+
+    def close(self) -> None:
+        if self._jsonl is not None:
+            self._jsonl.close()
+            self._jsonl = None
+        if self.prometheus_path is not None:
+            self.write_prometheus(self.prometheus_path)
+        if self.profiler is not None:
+            self.profiler.dump(Path(f'{self.tool}.prof'), self.worker_stats_dir)
+            self.profiler = None
+            shutil.rmtree(self.worker_stats_dir, ignore_errors=True)
+
+    def write_prometheus(self, path: Path) -> None:
+        tool = f'tool="{self.tool}"'
+        lines = [
+            f'# HELP {METRIC_PREFIX}_files_total Files processed by status.',
+            f'# TYPE {METRIC_PREFIX}_files_total counter',
+            *(f'{METRIC_PREFIX}_files_total{{{tool},status="{status}"}} {count}'
+              for status, count in sorted(self._files.items())),
+            f'# HELP {METRIC_PREFIX}_stage_seconds_total Time spent in each processing stage.',
+            f'# TYPE {METRIC_PREFIX}_stage_seconds_total counter',
+            *(f'{METRIC_PREFIX}_stage_seconds_total{{{tool},stage="{stage}"}} {seconds:.6f}'
+              for stage, seconds in sorted(self._stage_seconds.items())),
+            f'# HELP {METRIC_PREFIX}_bytes_in_total Bytes read from source files.',
+            f'# TYPE {METRIC_PREFIX}_bytes_in_total counter',
+            f'{METRIC_PREFIX}_bytes_in_total{{{tool}}} {self._bytes_in}',
+            f'# HELP {METRIC_PREFIX}_bytes_out_total Bytes written to output files.',
+            f'# TYPE {METRIC_PREFIX}_bytes_out_total counter',
+            f'{METRIC_PREFIX}_bytes_out_total{{{tool}}} {self._bytes_out}',
+        ]
+        if self._bytes_out:
+            lines += [
+                f'# HELP {METRIC_PREFIX}_compression_ratio Total bytes in divided by total bytes out.',
+                f'# TYPE {METRIC_PREFIX}_compression_ratio gauge',
+                f'{METRIC_PREFIX}_compression_ratio{{{tool}}} {self._bytes_in / self._bytes_out:.4f}',
+            ]
+        # The collector may read the file at any time, so replace it atomically
+        tmp_path = path.with_name(f'{path.name}.tmp')
+        tmp_path.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+        os.replace(tmp_path, path)
+
+
+def add_metrics_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--metrics_file', '-mf', type=Path, default=None,
+                        help='JSON Lines file to append per-file stage timings, sizes and errors to.')
+    parser.add_argument('--prometheus_file', '-pf', type=Path, default=None,
+                        help='Prometheus textfile to write run totals to.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Wrap processing stages with cProfile/tracemalloc and save <tool>.prof. '
+                             'Stages running in worker processes are profiled per worker and merged into the stats.')
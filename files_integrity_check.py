@@ -1,27 +1,33 @@
+import argparse
 import subprocess
 from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
 import pillow_heif
 from PIL import Image
 from tqdm import tqdm
 
+from file_metrics import MetricsRecorder, add_metrics_arguments
+
 # Register HEIF/AVIF formats with PIL
 pillow_heif.register_heif_opener()
 pillow_heif.register_avif_opener()
 
 
-def check_image(file_path: Path):
-    """Checks the integrity of an image file using Pillow (PIL)"""
+def check_image(file_path: Path) -> str | None:
+    """Checks the integrity of an image file using Pillow (PIL), returns the error if any"""
     try:
         with Image.open(file_path) as img:
             img.verify()  # Verify image integrity using Pillow
     except (IOError, SyntaxError) as e:
         print(f"{file_path}: Image verification failed - {e}")
+        return f"Image verification failed - {e}"
+    return None
 
 
-def check_video(file_path: Path):
-    """Checks video files (H.264/H.265) using ffmpeg"""
+def check_video(file_path: Path) -> str | None:
+    """Checks video files (H.264/H.265) using ffmpeg, returns the error if any"""
     try:
         result = subprocess.run(
             ["ffmpeg", "-v", "error", "-i", file_path, "-f", "null", "-"],
@@ -29,47 +35,59 @@ def check_video(file_path: Path):
         )
         if result.returncode != 0:
             print(f"{file_path}: Video errors:\n{result.stderr.decode()}")
+            return f"Video errors: {result.stderr.decode()}"
     except Exception as e:
         print(f"{file_path}: Error processing video - {e}")
+        return f"Error processing video - {e}"
+    return None
 
 
-def process_file(file_path: Path, supported_image_extensions: set[str]):
+def process_file(file_path: Path, supported_image_extensions: set[str], recorder: MetricsRecorder):
     """Processes a single file based on its extension"""
     file_extension = file_path.suffix.lower()
 
-    if file_extension in supported_image_extensions:
-        check_image(file_path)
-    elif file_extension in (".mp4", ".mkv", ".mov"):  # video file extensions
-        check_video(file_path)
-    else:
-        print(f"{file_path}: Unsupported file type.")
-
-
-def process_files_concurrently(directory: Path, supported_image_extensions: set[str], max_workers: int = 4):
+    with recorder.file(file_path) as record:
+        record.bytes_in = file_path.stat().st_size
+        if file_extension in supported_image_extensions:
+            with record.stage('verify'):
+                record.error = check_image(file_path)
+        elif file_extension in (".mp4", ".mkv", ".mov"):  # video file extensions
+            with record.stage('verify'):
+                record.error = check_video(file_path)
+        else:
+            print(f"{file_path}: Unsupported file type.")
+            record.skipped = True
+
+
+def process_files_concurrently(directory: Path, supported_image_extensions: set[str], recorder: MetricsRecorder,
+                               max_workers: int = 4):
     """Processes files and directories recursively using ThreadPoolExecutor."""
     files_to_process = []
 
     # Recursively collect all files in the directory and filter by supported extensions
-    for file_path in directory.rglob('*'):
-        if file_path.is_file() and file_path.suffix.lower() in supported_image_extensions:
-            files_to_process.append(file_path)
+    with recorder.stage('scan'):
+        for file_path in directory.rglob('*'):
+            if file_path.is_file() and file_path.suffix.lower() in supported_image_extensions:
+                files_to_process.append(file_path)
 
     # Concurrent execution with ThreadPoolExecutor
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        executor.map(process_file, files_to_process)
+        executor.map(partial(process_file, supported_image_extensions=supported_image_extensions, recorder=recorder),
+                     files_to_process)
 
 
-def process_files(directory: Path, supported_image_extensions: set[str]):
+def process_files(directory: Path, supported_image_extensions: set[str], recorder: MetricsRecorder):
     """Processes files and directories recursively using ThreadPoolExecutor."""
     files_to_process = []
 
     # Recursively collect all files in the directory and filter by supported extensions
-    for file_path in directory.rglob('*'):
-        if file_path.is_file() and file_path.suffix.lower() in supported_image_extensions:
-            files_to_process.append(file_path)
+    with recorder.stage('scan'):
+        for file_path in directory.rglob('*'):
+            if file_path.is_file() and file_path.suffix.lower() in supported_image_extensions:
+                files_to_process.append(file_path)
 
     for file_path in tqdm(files_to_process):
-        process_file(file_path, supported_image_extensions)
+        process_file(file_path, supported_image_extensions, recorder)
 
 
 def get_supported_image_extensions() -> set[str]:
@@ -78,6 +96,10 @@ def get_supported_image_extensions() -> set[str]:
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check integrity of image and video files in a directory.")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
     # Get the directory path from the user
     directory = Path(input("Enter the path to the directory: "))
 
@@ -87,5 +109,6 @@ if __name__ == "__main__":
     supported_image_extensions = get_supported_image_extensions()
 
     # Concurrent processing with 4 threads (you can adjust max_workers)
-    # process_files_concurrently(directory, supported_image_extensions, max_workers=os.cpu_count())
-    process_files(directory, supported_image_extensions)
+    with MetricsRecorder.from_args("files_integrity_check", args) as recorder:
+        # process_files_concurrently(directory, supported_image_extensions, recorder, max_workers=os.cpu_count())
+        process_files(directory, supported_image_extensions, recorder)
@@ -46,8 +46,8 @@ def process_images(json_path: str, output_json_path: str, moved_copies_dir: str,
                 elif res2 > res1:
                     to_move = img1
                 else:
-                    # Same resolution, check codec priority (AVIF/HEIF preferred)
-                    codec_priority = {'avif': 3, 'heif': 2, 'png': 1}
+                    # Same resolution, check codec priority (AVIF/HEIF preferred, AV1/HEVC for video pairs)
+                    codec_priority = {'avif': 3, 'heif': 2, 'png': 1, 'av1': 3, 'hevc': 2, 'h264': 1}
                     codec1 = entry["img1_codec"]
 
                     priority1 = codec_priority.get(codec1, -1)
@@ -92,7 +92,7 @@ def main():
         description="Process image pairs from JSON, move duplicates, and save filtered results. "
                     "If no priority directory is specified, the decision to keep an image is based on: "
                     "1) higher resolution (width × height), "
-                    "2) better codec (AVIF > HEIF > PNG > Others), "
+                    "2) better codec (AVIF > HEIF > PNG > Others, AV1 > HEVC > H.264 > Others for videos), "
                     "3) larger file size if resolutions and codecs are equal."
     )
     parser.add_argument("-ij", "--input_json", type=str, required=True, help="Path to the input JSON file")
@@ -13,6 +13,10 @@ from imagehash import ImageHash, phash
 from pillow_heif import register_heif_opener, register_avif_opener
 from tqdm import tqdm
 
+from file_metrics import FileRecord, MetricsRecorder, add_metrics_arguments, worker_profiling
+from memory_budget import add_memory_budget_argument, estimate_hash_memory, imap_with_memory_budget, \
+    memory_budget_bytes
+
 register_heif_opener()
 register_avif_opener()
 
@@ -30,23 +34,31 @@ class MatchedPairInfo:
     distance: int
 
 
+@dataclass(slots=True)
+class ImageIndexEntry:
+    hash: ImageHash
+    aspect_ratio: float
+    file_size: int
+    mtime_ns: int
+
+
 def main():
     args = parse_arguments()
     assert_directories_exist(args.dir1, args.dir2)
 
-    hashes_dir1 = hash_images_in_directory(args.dir1, args.hash_size)
-    with open('hashes_dir1.pkl', 'wb') as f:
-        pickle.dump(hashes_dir1, f)
+    with MetricsRecorder.from_args('find_similar_images', args) as recorder:
+        known1 = load_hash_index(args.index1, args.hash_size) if args.reuse_index else {}
+        memory_budget = memory_budget_bytes(args)
+        hashes_dir1 = hash_images_in_directory(args.dir1, args.hash_size, recorder, known1, memory_budget)
+        save_hash_index(hashes_dir1, args.index1)
 
-    # with open('hashes_dir1.pkl', 'rb') as f:
-    #     hashes_dir1 = pickle.load(f)
+        known2 = load_hash_index(args.index2, args.hash_size) if args.reuse_index else {}
+        hashes_dir2 = hash_images_in_directory(args.dir2, args.hash_size, recorder, known2, memory_budget)
+        save_hash_index(hashes_dir2, args.index2)
 
-    hashes_dir2 = hash_images_in_directory(args.dir2, args.hash_size)
-    with open('hashes_dir2.pkl', 'wb') as f:
-        pickle.dump(hashes_dir2, f)
-
-    similar_images = compare_hashes(hashes_dir1, hashes_dir2, args.distance)
-    similar_images.sort(key=lambda x: x.distance)  # Sort by similarity score (Hamming distance)
+        with recorder.stage('compare'):
+            similar_images = compare_hashes(hashes_dir1, hashes_dir2, args.distance)
+        similar_images.sort(key=lambda x: x.distance)  # Sort by similarity score (Hamming distance)
 
     write_similar_images_to_file(similar_images, args.output_file)
     print(f"Similar images written to {args.output_file}.json")
@@ -62,6 +74,19 @@ def parse_arguments() -> argparse.Namespace:
         '--distance', '-d', help='Maximum Hamming distance to consider images as similar.', type=int, default=8
     )
     parser.add_argument('--hash_size', '-hs', help='Hash size for perceptual hashing.', type=int, default=16)
+    parser.add_argument(
+        '--index1', '-i1', help='Pickled hash index of dir1.', type=Path, default=Path('hashes_dir1.pkl')
+    )
+    parser.add_argument(
+        '--index2', '-i2', help='Pickled hash index of dir2.', type=Path, default=Path('hashes_dir2.pkl')
+    )
+    parser.add_argument(
+        '--reuse_index', '-ri', action='store_true',
+        help='Load existing hash indexes (e.g. kept up to date by watch_directory.py) and hash only new or modified images. '
+             'Directories must be given the same way as when the index was built.'
+    )
+    add_memory_budget_argument(parser)
+    add_metrics_arguments(parser)
     return parser.parse_args()
 
 
@@ -71,40 +96,95 @@ def assert_directories_exist(*directories: Path) -> None:
             raise ValueError(f'{directory} is not a valid directory.')
 
 
-def hash_image(args: tuple[Path, int]) -> tuple[Path, ImageHash | None, float]:
-    img_path, hash_size = args
+def hash_image(args: tuple[Path, int, Path | None]) -> tuple[Path, ImageIndexEntry | None, FileRecord]:
+    img_path, hash_size, profile_stats_dir = args
+    # Runs in a worker process, the record is sent back to the recorder of the main process
+    record = FileRecord(path=str(img_path))
     try:
-        with Image.open(img_path) as img:
-            img_hash = phash(img, hash_size=hash_size)
-            aspect_ratio = img.width / img.height
-            return img_path, img_hash, aspect_ratio
+        # Taken before decoding, a file modified meanwhile is hashed again on the next run
+        stat = img_path.stat()
+        record.bytes_in = stat.st_size
+        with worker_profiling(record, profile_stats_dir), Image.open(img_path) as img:
+            with record.stage('decode'):
+                img.load()
+            with record.stage('hash'):
+                img_hash = phash(img, hash_size=hash_size)
+            entry = ImageIndexEntry(hash=img_hash, aspect_ratio=img.width / img.height,
+                                    file_size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            return img_path, entry, record
     except Exception as e:
         print(f"\nError processing {img_path}: {e}")
-        return img_path, None, 0.0
+        record.error = f'{type(e).__name__}: {e}'
+        return img_path, None, record
+
+
+def load_hash_index(index_path: Path, hash_size: int) -> dict[Path, ImageIndexEntry]:
+    if not index_path.exists():
+        return {}
+    with open(index_path, 'rb') as f:
+        image_hashes = pickle.load(f)
+    if not all(isinstance(entry, ImageIndexEntry) for entry in image_hashes.values()):
+        print(f"{index_path} has no file sizes and modification times, ignoring the index")
+        return {}
+    if any(entry.hash.hash.shape != (hash_size, hash_size) for entry in image_hashes.values()):
+        print(f"Hash size in {index_path} differs from {hash_size}, ignoring the index")
+        return {}
+    return image_hashes
 
 
-def hash_images_in_directory(directory: Path, hash_size: int) -> dict[Path, tuple[ImageHash, float]]:
+def save_hash_index(image_hashes: dict[Path, ImageIndexEntry], index_path: Path) -> None:
+    # Written to a temp file first, the index may be read by another process at the same time
+    tmp_path = index_path.with_name(f'{index_path.name}.tmp')
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(image_hashes, f)
+    os.replace(tmp_path, index_path)
+
+
+def hash_images_in_directory(directory: Path, hash_size: int, recorder: MetricsRecorder,
+                             known_hashes: dict[Path, ImageIndexEntry] | None = None,
+                             memory_budget: int | None = None) -> dict[Path, ImageIndexEntry]:
+    """
+    Hash all images in the directory, reusing known_hashes of files which did not change.
+    Workers start an image only when its estimated decoded size fits into memory_budget.
+    """
+    with recorder.stage('scan'):
+        all_paths = {file for file in directory.rglob('*') if file.is_file()}
+    known_hashes = known_hashes or {}
     image_hashes = {}
-    all_paths = {file for file in directory.rglob('*') if file.is_file()}
-    img_paths = [img_path for img_path in all_paths if img_path.suffix.lower() in SUPPORTED_EXTENSIONS]
-
-    ignored_files = all_paths - set(img_paths)
+    for path, entry in known_hashes.items():
+        if path not in all_paths:
+            continue
+        stat = path.stat()
+        if (entry.file_size, entry.mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+            image_hashes[path] = entry
+    img_paths = [
+        img_path for img_path in all_paths
+        if img_path.suffix.lower() in SUPPORTED_EXTENSIONS and img_path not in image_hashes
+    ]
+
+    ignored_files = all_paths - set(img_paths) - set(image_hashes)
     print("Ignored files:")
     for p in ignored_files:
         print(p.as_posix())
 
-    input_data = [(img_path, hash_size) for img_path in img_paths]
+    input_data = [(img_path, hash_size, recorder.worker_stats_dir) for img_path in img_paths]
+    with recorder.stage('estimate'):
+        costs = [estimate_hash_memory(img_path) for img_path in img_paths]
     with Pool(processes=cpu_count()) as pool:
-        imap = pool.imap(hash_image, input_data)
-        for img_path, img_hash, aspect_ratio in tqdm(imap, total=len(img_paths), desc="Hashing images"):
-            if img_hash is not None:
-                image_hashes[img_path] = (img_hash, aspect_ratio)
+        if memory_budget is None:
+            imap = pool.imap(hash_image, input_data)
+        else:
+            imap = imap_with_memory_budget(pool, hash_image, input_data, costs, memory_budget, cpu_count())
+        for img_path, entry, record in tqdm(imap, total=len(img_paths), desc="Hashing images"):
+            recorder.add(record)
+            if entry is not None:
+                image_hashes[img_path] = entry
     return image_hashes
 
 
 def compare_hashes(
-        hashes_dir1: dict[Path, tuple[ImageHash, float]],
-        hashes_dir2: dict[Path, tuple[ImageHash, float]],
+        hashes_dir1: dict[Path, ImageIndexEntry],
+        hashes_dir2: dict[Path, ImageIndexEntry],
         max_distance: int
 ) -> list[MatchedPairInfo]:
     paths1 = list(hashes_dir1.keys())
@@ -145,15 +225,15 @@ def compare_hashes(
 
 
 def get_hash_differencies(hashes_dir1, hashes_dir2):
-    hashes1 = np.array([h[0].hash for h in hashes_dir1.values()], dtype=bool)
-    hashes2 = np.array([h[0].hash for h in hashes_dir2.values()], dtype=bool)
+    hashes1 = np.array([h.hash.hash for h in hashes_dir1.values()], dtype=bool)
+    hashes2 = np.array([h.hash.hash for h in hashes_dir2.values()], dtype=bool)
     differences = hashes1[:, np.newaxis, :, :] != hashes2[np.newaxis, :, :, :]
     return np.sum(differences, axis=(2, 3), dtype=np.int32)
 
 
 def get_aspects_differences(hashes_dir1, hashes_dir2):
-    aspects1 = np.array([h[1] for h in hashes_dir1.values()], dtype=np.float32)
-    aspects2 = np.array([h[1] for h in hashes_dir2.values()], dtype=np.float32)
+    aspects1 = np.array([h.aspect_ratio for h in hashes_dir1.values()], dtype=np.float32)
+    aspects2 = np.array([h.aspect_ratio for h in hashes_dir2.values()], dtype=np.float32)
     return np.abs(aspects1[:, np.newaxis] - aspects2[np.newaxis, :])
 
 
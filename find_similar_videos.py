@@ -0,0 +1,274 @@
+import argparse
+import json
+import os
+import pickle
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+from imagehash import phash
+from tqdm import tqdm
+
+from convert_video import is_video_file
+from file_metrics import MetricsRecorder, add_metrics_arguments
+from find_similar_images import MatchedPairInfo, assert_directories_exist, write_similar_images_to_file
+
+
+@dataclass(slots=True)
+class VideoFingerprint:
+    hashes: np.ndarray  # (frames, hash_size * hash_size) bool, phash of sampled keyframes in playback order
+    codec: str
+    size: tuple[int, int]
+    duration: float
+    file_size: int
+    mtime_ns: int
+
+
+def main():
+    args = parse_arguments()
+    assert_directories_exist(args.dir1, args.dir2)
+
+    with MetricsRecorder.from_args('find_similar_videos', args) as recorder:
+        known1 = load_video_index(args.index1, args.hash_size) if args.reuse_index else {}
+        fingerprints1 = fingerprint_videos_in_directory(args.dir1, args, recorder, known1)
+        save_video_index(fingerprints1, args.index1)
+
+        known2 = load_video_index(args.index2, args.hash_size) if args.reuse_index else {}
+        fingerprints2 = fingerprint_videos_in_directory(args.dir2, args, recorder, known2)
+        save_video_index(fingerprints2, args.index2)
+
+        with recorder.stage('compare'):
+            similar_videos = compare_fingerprints(fingerprints1, fingerprints2, args.distance)
+        similar_videos.sort(key=lambda x: x.distance)
+
+    write_similar_images_to_file(similar_videos, args.output_file)
+    print(f"Similar videos written to {args.output_file}.json")
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Find re-exported, re-encoded or trimmed copies of videos between two directories. '
+                    'Sampled keyframes are hashed with perceptual hash and the hash sequences are aligned. '
+                    'The output has the same format as find_similar_images.py.')
+    parser.add_argument('--dir1', '-d1', help='First directory to search for videos.', type=Path, required=True)
+    parser.add_argument('--dir2', '-d2', help='Second directory to search for videos.', type=Path, required=True)
+    parser.add_argument('--output_file', '-o', help='File to store results of similar videos.', type=str,
+                        required=True)
+    parser.add_argument(
+        '--distance', '-d', help='Maximum mean Hamming distance of aligned keyframes to consider videos as similar.',
+        type=int, default=16
+    )
+    parser.add_argument('--hash_size', '-hs', help='Hash size for perceptual hashing.', type=int, default=16)
+    parser.add_argument('--frames', '-f', help='Number of keyframes sampled from each video.', type=int, default=32)
+    parser.add_argument(
+        '--index1', '-i1', help='Pickled keyframe hash index of dir1.', type=Path, default=Path('videos_dir1.pkl')
+    )
+    parser.add_argument(
+        '--index2', '-i2', help='Pickled keyframe hash index of dir2.', type=Path, default=Path('videos_dir2.pkl')
+    )
+    parser.add_argument(
+        '--reuse_index', '-ri', action='store_true',
+        help='Load existing indexes and fingerprint only new or modified videos. '
+             'Directories must be given the same way as when the index was built.'
+    )
+    parser.add_argument('--workers', '-w', help='Number of videos decoded in parallel.', type=int,
+                        default=os.cpu_count())
+    add_metrics_arguments(parser)
+    return parser.parse_args()
+
+
+def probe_video_stream(file: Path) -> tuple[str, tuple[int, int], float]:
+    """Codec, resolution and duration of the first video stream"""
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries',
+         'format=duration:stream=codec_name,width,height', '-of', 'json', str(file)],
+        capture_output=True, text=True, check=True
+    )
+    info = json.loads(result.stdout)
+    stream = info['streams'][0]
+    return stream['codec_name'], (int(stream['width']), int(stream['height'])), float(info['format']['duration'])
+
+
+def read_keyframes(file: Path, duration: float, frames: int, side: int) -> np.ndarray:
+    """
+    Up to `frames` keyframes spread over the video as (n, side, side) grayscale array.
+    The decoder skips all non-key frames and the kept ones are downscaled right after decoding,
+    so only a small fraction of the video is decoded and almost nothing is copied through the pipe.
+    """
+    interval = duration / frames
+    call_args = [
+        'ffmpeg', '-v', 'error', '-skip_frame', 'nokey', '-i', str(file), '-map', '0:v:0',
+        '-vf', f"select='isnan(prev_selected_t)+gte(t-prev_selected_t,{interval:.3f})',"
+               f"scale={side}:{side},format=gray",
+        '-fps_mode', 'vfr', '-frames:v', str(frames), '-f', 'rawvideo', 'pipe:1'
+    ]
+    result = subprocess.run(call_args, capture_output=True, check=True)
+    keyframes = np.frombuffer(result.stdout, dtype=np.uint8)
+    return keyframes[:keyframes.size // (side * side) * side * side].reshape(-1, side, side)
+
+
+def video_preview(file: Path) -> Image.Image:
+    """Keyframe from the middle of the video, shown in place of the image by compare_images_app.py"""
+    _, _, duration = probe_video_stream(file)
+    result = subprocess.run(
+        ['ffmpeg', '-v', 'error', '-skip_frame', 'nokey', '-ss', f'{duration / 2:.3f}', '-i', str(file),
+         '-map', '0:v:0', '-frames:v', '1', '-c:v', 'png', '-f', 'image2pipe', 'pipe:1'],
+        capture_output=True, check=True
+    )
+    return Image.open(BytesIO(result.stdout))
+
+
+def fingerprint_video(file: Path, hash_size: int, frames: int, recorder: MetricsRecorder) -> VideoFingerprint | None:
+    with recorder.file(file) as record:
+        try:
+            stat = file.stat()
+            record.bytes_in = stat.st_size
+            with record.stage('probe'):
+                codec, size, duration = probe_video_stream(file)
+            with record.stage('keyframes'):
+                # phash works on a (4 * hash_size)^2 grayscale image, so decode straight to that size
+                keyframes = read_keyframes(file, duration, frames, 4 * hash_size)
+            if not len(keyframes):
+                raise ValueError('no keyframes decoded')
+            with record.stage('hash'):
+                hashes = np.array(
+                    [phash(Image.fromarray(frame), hash_size=hash_size).hash.ravel() for frame in keyframes],
+                    dtype=bool
+                )
+            record.extra['keyframes'] = len(hashes)
+            return VideoFingerprint(hashes=hashes, codec=codec, size=size, duration=duration,
+                                    file_size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        except subprocess.CalledProcessError as e:
+            stderr = e.stderr.decode(errors='replace') if isinstance(e.stderr, bytes) else e.stderr
+            print(f"\nError processing {file}: {stderr}")
+            record.error = f'{e.cmd[0]} exited with {e.returncode}: {stderr}'
+        except (OSError, KeyError, IndexError, ValueError) as e:
+            print(f"\nError processing {file}: {e}")
+            record.error = f'{type(e).__name__}: {e}'
+        return None
+
+
+def load_video_index(index_path: Path, hash_size: int) -> dict[Path, VideoFingerprint]:
+    if not index_path.exists():
+        return {}
+    with open(index_path, 'rb') as f:
+        fingerprints = pickle.load(f)
+    if any(fp.hashes.shape[1] != hash_size * hash_size for fp in fingerprints.values()):
+        print(f"Hash size in {index_path} differs from {hash_size}, ignoring the index")
+        return {}
+    return fingerprints
+
+
+def save_video_index(fingerprints: dict[Path, VideoFingerprint], index_path: Path) -> None:
+    tmp_path = index_path.with_name(f'{index_path.name}.tmp')
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(fingerprints, f)
+    os.replace(tmp_path, index_path)
+
+
+def fingerprint_videos_in_directory(directory: Path, args: argparse.Namespace, recorder: MetricsRecorder,
+                                    known: dict[Path, VideoFingerprint] | None = None) -> dict[Path, VideoFingerprint]:
+    """Fingerprint all videos in the directory, reusing known fingerprints of files which did not change"""
+    with recorder.stage('scan'):
+        files = [file for file in directory.rglob('*') if file.is_file() and is_video_file(file)]
+    known = known or {}
+    fingerprints = {}
+    to_process = []
+    for file in files:
+        known_fp = known.get(file)
+        stat = file.stat()
+        if known_fp is not None and (known_fp.file_size, known_fp.mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+            fingerprints[file] = known_fp
+        else:
+            to_process.append(file)
+
+    # Decoding happens in ffmpeg processes, threads only wait for them and hash a few tiny frames
+    fingerprint = partial(fingerprint_video, hash_size=args.hash_size, frames=args.frames, recorder=recorder)
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        results = tqdm(executor.map(fingerprint, to_process), total=len(to_process), desc=f'Hashing {directory}')
+        for file, result in zip(to_process, results):
+            if result is not None:
+                fingerprints[file] = result
+    return fingerprints
+
+
+def hamming_distances(hashes1: np.ndarray, hashes2: np.ndarray) -> np.ndarray:
+    """Pairwise Hamming distances of two (n, bits) boolean hash arrays, computed with a matrix product"""
+    a = hashes1.astype(np.float32)
+    b = hashes2.astype(np.float32)
+    return a.sum(axis=1)[:, np.newaxis] + b.sum(axis=1)[np.newaxis, :] - 2 * (a @ b.T)
+
+
+def alignment_distance(distances: np.ndarray) -> float:
+    """
+    Best subsequence DTW alignment of the shorter video (rows) to any contiguous part of the longer one (columns),
+    as mean Hamming distance per keyframe of the shorter video. The free start and end on the longer video match
+    trimmed copies. Keyframes of the shorter video are sampled more densely, so several of them may align to
+    one keyframe of the longer video at no extra cost, while skipping keyframes of the longer video costs distance.
+    """
+    rows, cols = distances.shape
+    cost = np.empty((rows, cols))
+    cost[0] = distances[0]
+    for i in range(1, rows):
+        cost[i, 0] = cost[i - 1, 0] + distances[i, 0]
+        for j in range(1, cols):
+            cost[i, j] = distances[i, j] + min(cost[i - 1, j], cost[i - 1, j - 1], cost[i, j - 1])
+    return float(cost[-1].min() / rows)
+
+
+def orientation_free_aspect(size: tuple[int, int]) -> float:
+    """
+    Longer side divided by the shorter one. ffprobe reports coded sizes without the rotation side data, while
+    convert_video.py stores rotated clips upright, so a 1920x1080 source and its 1080x1920 re-encode must match.
+    """
+    return max(size) / min(size)
+
+
+def compare_fingerprints(
+        fingerprints1: dict[Path, VideoFingerprint],
+        fingerprints2: dict[Path, VideoFingerprint],
+        max_distance: int
+) -> list[MatchedPairInfo]:
+    if not fingerprints1 or not fingerprints2:
+        return []
+    paths2 = list(fingerprints2.keys())
+    all_hashes2 = np.concatenate([fp.hashes for fp in fingerprints2.values()])
+    counts2 = np.array([len(fp.hashes) for fp in fingerprints2.values()])
+    starts2 = np.cumsum(counts2) - counts2
+    durations2 = np.array([fp.duration for fp in fingerprints2.values()])
+    aspects2 = np.array([orientation_free_aspect(fp.size) for fp in fingerprints2.values()], dtype=np.float32)
+
+    similar_videos = []
+    for path1, fp1 in tqdm(fingerprints1.items(), desc='Comparing videos'):
+        distances = hamming_distances(fp1.hashes, all_hashes2)
+        # Lower bounds of alignment_distance: each keyframe of the shorter video matched to its closest keyframe
+        # of the other one, computed for all videos of dir2 at once
+        bound_rows1 = np.minimum.reduceat(distances, starts2, axis=1).mean(axis=0)
+        bound_rows2 = np.add.reduceat(distances.min(axis=0), starts2) / counts2
+        lower_bound = np.where(durations2 < fp1.duration, bound_rows2, bound_rows1)
+        candidates = (lower_bound < max_distance) & (np.abs(aspects2 - orientation_free_aspect(fp1.size)) < 0.01)
+
+        for j in np.flatnonzero(candidates):
+            fp2 = fingerprints2[paths2[j]]
+            pair_distances = distances[:, starts2[j]:starts2[j] + counts2[j]]
+            distance = alignment_distance(pair_distances.T if fp2.duration < fp1.duration else pair_distances)
+            if distance < max_distance:
+                similar_videos.append(MatchedPairInfo(
+                    img1=str(path1),
+                    img2=str(paths2[j]),
+                    img1_codec=fp1.codec,
+                    img2_codec=fp2.codec,
+                    img1_size=fp1.size,
+                    img2_size=fp2.size,
+                    distance=round(distance)
+                ))
+    return similar_videos
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+from io import BytesIO
+from math import log10, sqrt
+
+import numpy as np
+from PIL import Image
+from pillow_heif import register_heif_opener, register_avif_opener
+
+register_heif_opener()
+register_avif_opener()
+
+CODEC_FORMATS = {'heif': 'HEIF', 'avif': 'AVIF', 'jpeg': 'JPEG', 'webp': 'WEBP'}
+METRICS = ('psnr', 'ssim')
+
+
+def psnr(original: np.ndarray, compressed: np.ndarray) -> float:
+    """Peak signal-to-noise ratio in dB, 100 for identical images"""
+    mse = np.mean((original.astype(np.float64) - compressed.astype(np.float64)) ** 2)
+    if mse == 0:  # No noise at all, PSNR is meaningless - return a fixed cap
+        return 100.0
+    max_pixel = 255.0
+    return 20 * log10(max_pixel / sqrt(mse))
+
+
+def _box_filter(arr: np.ndarray, window: int) -> np.ndarray:
+    """Mean over every window x window block (valid region only) using an integral image"""
+    integral = np.pad(arr, ((1, 0), (1, 0))).cumsum(axis=0).cumsum(axis=1)
+    sums = (
+            integral[window:, window:] - integral[:-window, window:]
+            - integral[window:, :-window] + integral[:-window, :-window]
+    )
+    return sums / (window * window)
+
+
+def _luma(arr: np.ndarray) -> np.ndarray:
+    arr = arr.astype(np.float64)
+    if arr.ndim == 2:
+        return arr
+    return 0.299 * arr[..., 0] + 0.587 * arr[..., 1] + 0.114 * arr[..., 2]
+
+
+def ssim(original: np.ndarray, compressed: np.ndarray, window: int = 7) -> float:
+    """Mean structural similarity of luma computed over a sliding uniform window"""
+    x = _luma(original)
+    y = _luma(compressed)
+    window = min(window, *x.shape)
+
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    mu_x = _box_filter(x, window)
+    mu_y = _box_filter(y, window)
+    var_x = _box_filter(x * x, window) - mu_x ** 2
+    var_y = _box_filter(y * y, window) - mu_y ** 2
+    cov_xy = _box_filter(x * y, window) - mu_x * mu_y
+
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * cov_xy + c2)) / ((mu_x ** 2 + mu_y ** 2 + c1) * (var_x + var_y + c2))
+    return float(np.mean(ssim_map))
+
+
+def compute_metric(metric: str, original: np.ndarray, compressed: np.ndarray) -> float:
+    if metric == 'psnr':
+        return psnr(original, compressed)
+    if metric == 'ssim':
+        return ssim(original, compressed)
+    raise ValueError(f'Unknown metric: {metric}')
+
+
+def encode_to_buffer(img: Image.Image, codec: str, quality: int, **save_kwargs) -> bytes:
+    buffer = BytesIO()
+    img.save(buffer, format=CODEC_FORMATS[codec], quality=quality, **save_kwargs)
+    return buffer.getvalue()
+
+
+def decode_buffer(data: bytes) -> np.ndarray:
+    with Image.open(BytesIO(data)) as img:
+        return np.asarray(img.convert('RGB'))
+
+
+def make_probe(img: Image.Image, probe_size: int) -> Image.Image:
+    """Downscaled RGB copy of the image with the longest side not larger than probe_size"""
+    probe = img.convert('RGB')
+    if max(probe.size) > probe_size:
+        probe.thumbnail((probe_size, probe_size), Image.Resampling.LANCZOS)
+    return probe
+
+
+def search_quality(img: Image.Image, codec: str, metric: str, target: float, min_quality: int = 0,
+                   max_quality: int = 100) -> tuple[int, float]:
+    """
+    Binary search for the lowest quality whose encode reaches the target metric value.
+    Assumes the metric grows monotonically with quality. Returns max_quality if target is never reached.
+    """
+    reference = np.asarray(img.convert('RGB'))
+    best_quality = max_quality
+    best_value = None
+    low, high = min_quality, max_quality
+    while low <= high:
+        quality = (low + high) // 2
+        value = compute_metric(metric, reference, decode_buffer(encode_to_buffer(img, codec, quality)))
+        if value >= target:
+            best_quality, best_value = quality, value
+            high = quality - 1
+        else:
+            low = quality + 1
+
+    if best_value is None:
+        best_value = compute_metric(metric, reference, decode_buffer(encode_to_buffer(img, codec, max_quality)))
+    return best_quality, best_value
+
+
+def encode_for_target(img: Image.Image, codec: str, metric: str, target: float, probe_size: int = 512,
+                      quality_step: int = 5, **save_kwargs) -> tuple[bytes, int, float]:
+    """
+    Encode an image with the lowest quality that meets the target metric value.
+    The search runs on a downscaled probe; the chosen quality is then verified on the full image
+    and raised by quality_step until the target is met. Returns encoded bytes, quality and achieved metric.
+    When even quality 100 misses the target (e.g. noise), the quality 100 encode is returned, callers must check.
+    """
+    quality, _ = search_quality(make_probe(img, probe_size), codec, metric, target)
+
+    reference = np.asarray(img.convert('RGB'))
+    while True:
+        data = encode_to_buffer(img, codec, quality, **save_kwargs)
+        value = compute_metric(metric, reference, decode_buffer(data))
+        if value >= target or quality >= 100:
+            return data, quality, value
+        quality = min(quality + quality_step, 100)
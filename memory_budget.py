@@ -0,0 +1,132 @@
+import argparse
+import queue
+from collections import deque
+from multiprocessing.pool import Pool
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Iterable, Iterator
+
+import psutil
+from PIL import Image
+from pillow_heif import register_heif_opener, register_avif_opener
+
+register_heif_opener()
+register_avif_opener()
+
+# Working set of a job as a multiple of the decoded image size
+HASH_MEMORY_FACTOR = 2.0  # decoded image + grayscale and resized copies made by phash
+ENCODE_MEMORY_FACTOR = {'heif': 4.0, 'avif': 5.0}  # decoded image + encoder input copy + encoder buffers
+# Quality search keeps the reference and decoded images as float64 arrays while computing PSNR/SSIM
+METRIC_BYTES_PER_PIXEL = 64
+# How many smaller jobs may overtake a job waiting for memory before the scheduler waits for it
+MAX_OVERTAKES = 16
+
+
+def add_memory_budget_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--memory_budget', '-mb', type=float, default=None,
+                        help='Memory in GB decoded images and encoders of all workers may use together '
+                             '(default: half of the RAM).')
+
+
+def memory_budget_bytes(args: argparse.Namespace) -> int:
+    if args.memory_budget is None:
+        return psutil.virtual_memory().total // 2
+    return int(args.memory_budget * 2 ** 30)
+
+
+def read_image_header(file: Path | BinaryIO) -> tuple[int, int, str] | None:
+    """Width, height and mode from the image header only, pixel data is not decoded"""
+    try:
+        with Image.open(file) as img:
+            return img.width, img.height, img.mode
+    except Exception:
+        return None
+
+
+def decoded_size(width: int, height: int, mode: str) -> int:
+    try:
+        bands = Image.getmodebands(mode)
+    except (KeyError, ValueError):
+        bands = 4
+    bytes_per_band = 2 if '16' in mode else 4 if mode in ('I', 'F') else 1
+    return width * height * bands * bytes_per_band
+
+
+def estimate_hash_memory(path: Path) -> int:
+    header = read_image_header(path)
+    return int(decoded_size(*header) * HASH_MEMORY_FACTOR) if header else 0
+
+
+def estimate_convert_memory(header: tuple[int, int, str], codec: str, targeted: bool = False) -> int:
+    width, height, mode = header
+    estimate = decoded_size(width, height, mode) * ENCODE_MEMORY_FACTOR[codec]
+    if targeted:
+        estimate += width * height * METRIC_BYTES_PER_PIXEL
+    return int(estimate)
+
+
+class MemoryAdmission:
+    """
+    Decides which pending job may start so the estimated memory of running jobs stays within memory_budget.
+    When the oldest job does not fit, later smaller jobs may start first (at most MAX_OVERTAKES times in a row)
+    so cores stay busy. A job larger than the whole budget runs alone. Not thread safe, owned by one thread.
+    """
+
+    def __init__(self, memory_budget: int, max_in_flight: int):
+        self.memory_budget = memory_budget
+        self.max_in_flight = max_in_flight
+        self.pending: deque[tuple[Any, int]] = deque()
+        self.used = 0
+        self.in_flight = 0
+        self._overtakes = 0
+
+    def add(self, job: Any, cost: int) -> None:
+        self.pending.append((job, cost))
+
+    def next_admitted(self) -> tuple[Any, int] | None:
+        if not self.pending or self.in_flight >= self.max_in_flight:
+            return None
+        free = self.memory_budget - self.used
+        _, head_cost = self.pending[0]
+        if head_cost <= free or self.in_flight == 0:
+            self._overtakes = 0
+            return self._start(self.pending.popleft())
+        if self._overtakes >= MAX_OVERTAKES:
+            return None
+        for i, (job, cost) in enumerate(self.pending):
+            if cost <= free:
+                del self.pending[i]
+                self._overtakes += 1
+                return self._start((job, cost))
+        return None
+
+    def release(self, cost: int) -> None:
+        self.used -= cost
+        self.in_flight -= 1
+
+    def _start(self, job_and_cost: tuple[Any, int]) -> tuple[Any, int]:
+        self.used += job_and_cost[1]
+        self.in_flight += 1
+        return job_and_cost
+
+
+def imap_with_memory_budget(pool: Pool, func: Callable, jobs: Iterable[Any], costs: Iterable[int],
+                            memory_budget: int, max_in_flight: int) -> Iterator[Any]:
+    """Like pool.imap_unordered, but jobs are started in the order and pace allowed by MemoryAdmission"""
+    admission = MemoryAdmission(memory_budget, max_in_flight)
+    for job, cost in zip(jobs, costs):
+        admission.add(job, cost)
+    results = queue.Queue()
+
+    for _ in range(len(admission.pending)):
+        while (admitted := admission.next_admitted()) is not None:
+            job, cost = admitted
+            pool.apply_async(
+                func, (job,),
+                callback=lambda result, cost=cost: results.put((cost, False, result)),
+                error_callback=lambda error, cost=cost: results.put((cost, True, error))
+            )
+        cost, failed, result = results.get()
+        admission.release(cost)
+        if failed:
+            raise result
+        yield result
@@ -0,0 +1,195 @@
+import argparse
+import json
+import subprocess
+import tempfile
+import time
+from dataclasses import dataclass, asdict
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from convert_video import AUDIO_ARGS, VIDEO_PRESET, VIDEO_QUALITY, is_video_file, video_encode_args
+
+
+@dataclass(slots=True)
+class VideoInfo:
+    path: Path
+    size: int
+    duration: float
+    fps: float
+
+
+@dataclass(slots=True)
+class ProfileEstimate:
+    preset: str
+    quality: int
+    sampled_s: float
+    encode_fps: float
+    realtime_factor: float
+    estimated_hours: float
+    estimated_gb: float
+    saved_percent: float
+
+
+def main():
+    args = parse_arguments()
+    assert args.src_path.exists(), f'src_path does not exist: {args.src_path.resolve()}'
+    assert args.src_path.is_dir(), f'src_path is not a directory: {args.src_path.resolve()}'
+
+    files = [file for file in args.src_path.rglob('*') if file.is_file() and is_video_file(file)]
+    videos = []
+    for file in tqdm(files, desc='Probing videos'):
+        try:
+            videos.append(probe_video(file))
+        except (subprocess.CalledProcessError, OSError, KeyError, IndexError, ValueError) as e:
+            # No video stream, unreadable file or missing ffprobe
+            print(f'Skipping file: {file} - {e}')
+    assert videos, f'No videos found in {args.src_path.resolve()}'
+
+    samples = select_representative(videos, args.sample_files)
+    print(f'Sampling {len(samples)} of {len(videos)} videos')
+
+    estimates = [
+        profile_encoding(videos, samples, preset, quality, args.segments, args.segment_duration)
+        for preset in args.presets
+        for quality in args.qualities
+    ]
+    print_estimates(estimates)
+
+    recommended = recommend_profile(estimates, args.time_budget, args.size_budget)
+    if args.time_budget is None and args.size_budget is None:
+        print('Pass --time_budget and/or --size_budget to get a recommendation.')
+    elif recommended is None:
+        print('No profile fits the given budget.')
+    else:
+        print(f'Recommended: -p {recommended.preset} -q {recommended.quality} '
+              f'(~{recommended.estimated_hours:.1f} h, ~{recommended.estimated_gb:.1f} GB)')
+
+    if args.output_file is not None:
+        with open(args.output_file, 'wt', encoding='utf-8') as f:
+            json.dump([asdict(estimate) for estimate in estimates], f, indent=2, ensure_ascii=False)
+        print(f'Estimates written to {args.output_file}')
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Encode short sampled segments of videos with several preset/quality profiles and '
+                    'extrapolate time and output size of converting the whole directory with convert_video.py.')
+    parser.add_argument('--src_path', '-s', type=Path, required=True,
+                        help='Path to the source directory containing video files.')
+    parser.add_argument('--presets', '-p', type=str, nargs='+', default=[VIDEO_PRESET, 'slow', 'medium', 'fast'],
+                        help='Encoder presets to profile.')
+    parser.add_argument('--qualities', '-q', type=int, nargs='+', default=[VIDEO_QUALITY],
+                        help='Values of ffmpeg -global_quality to profile.')
+    parser.add_argument('--sample_files', '-sf', type=int, default=10,
+                        help='Number of videos sampled, spread evenly over the file size distribution.')
+    parser.add_argument('--segments', '-sg', type=int, default=3, help='Segments encoded per sampled video.')
+    parser.add_argument('--segment_duration', '-sd', type=float, default=10.0, help='Segment length in seconds.')
+    parser.add_argument('--time_budget', '-tb', type=float, default=None, help='Maximum batch time in hours.')
+    parser.add_argument('--size_budget', '-sb', type=float, default=None, help='Maximum batch output size in GB.')
+    parser.add_argument('--output_file', '-o', type=Path, default=None, help='JSON file to store the estimates.')
+    return parser.parse_args()
+
+
+def probe_video(file: Path) -> VideoInfo:
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'format=duration:stream=avg_frame_rate',
+         '-of', 'json', str(file)],
+        capture_output=True, text=True, check=True
+    )
+    info = json.loads(result.stdout)
+    numerator, _, denominator = info['streams'][0]['avg_frame_rate'].partition('/')
+    denominator = float(denominator or 1)
+    fps = float(numerator) / denominator if denominator else 0.0
+    return VideoInfo(path=file, size=file.stat().st_size, duration=float(info['format']['duration']), fps=fps)
+
+
+def select_representative(videos: list[VideoInfo], count: int) -> list[VideoInfo]:
+    """Pick videos at evenly spaced quantiles of file size, so small clips and long recordings are both covered"""
+    if len(videos) <= count:
+        return list(videos)
+    by_size = sorted(videos, key=lambda v: v.size)
+    indices = np.unique(np.linspace(0, len(by_size) - 1, count).round().astype(int))
+    return [by_size[i] for i in indices]
+
+
+def segment_starts(duration: float, segments: int, segment_duration: float) -> list[float]:
+    if duration <= segments * segment_duration:
+        return [0.0]
+    # Spread segments evenly, skipping the very beginning and end which are often static
+    step = duration / (segments + 1)
+    return [step * (i + 1) - segment_duration / 2 for i in range(segments)]
+
+
+def encode_segment(file: Path, start: float, duration: float, preset: str, quality: int,
+                   out_file: Path) -> tuple[float, int]:
+    call_args = [
+        'ffmpeg', '-v', 'error', '-ss', f'{start:.3f}', '-t', f'{duration:.3f}', '-i', str(file),
+        *video_encode_args(quality, preset), *AUDIO_ARGS, str(out_file), '-y'
+    ]
+    start_time = time.perf_counter()
+    subprocess.run(call_args, capture_output=True, text=True, check=True)
+    return time.perf_counter() - start_time, out_file.stat().st_size
+
+
+def profile_encoding(videos: list[VideoInfo], samples: list[VideoInfo], preset: str, quality: int, segments: int,
+                     segment_duration: float) -> ProfileEstimate:
+    encoded_s = wall_s = frames = 0.0
+    out_bytes = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_file = Path(tmp_dir) / 'segment.mp4'
+        for video in tqdm(samples, desc=f'Profiling {preset} q={quality}'):
+            for start in segment_starts(video.duration, segments, segment_duration):
+                duration = min(segment_duration, video.duration - start)
+                try:
+                    elapsed, size = encode_segment(video.path, start, duration, preset, quality, out_file)
+                except subprocess.CalledProcessError as e:
+                    print(f'Failed to encode segment of {video.path}: {e.stderr}')
+                    continue
+                encoded_s += duration
+                wall_s += elapsed
+                frames += duration * video.fps
+                out_bytes += size
+
+    total_duration = sum(v.duration for v in videos)
+    total_size = sum(v.size for v in videos)
+    realtime_factor = encoded_s / wall_s if wall_s else 0.0
+    estimated_bytes = out_bytes / encoded_s * total_duration if encoded_s else 0.0
+    return ProfileEstimate(
+        preset=preset,
+        quality=quality,
+        sampled_s=round(encoded_s, 1),
+        encode_fps=round(frames / wall_s, 2) if wall_s else 0.0,
+        realtime_factor=round(realtime_factor, 3),
+        estimated_hours=round(total_duration / realtime_factor / 3600, 2) if realtime_factor else float('inf'),
+        estimated_gb=round(estimated_bytes / 1e9, 2),
+        saved_percent=round(100 * (1 - estimated_bytes / total_size), 1) if total_size else 0.0,
+    )
+
+
+def recommend_profile(estimates: list[ProfileEstimate], time_budget: float | None,
+                      size_budget: float | None) -> ProfileEstimate | None:
+    """Smallest output among profiles fitting the budgets, the faster one on ties"""
+    if time_budget is None and size_budget is None:
+        return None
+    fitting = [
+        e for e in estimates
+        if e.sampled_s > 0
+        and (time_budget is None or e.estimated_hours <= time_budget)
+        and (size_budget is None or e.estimated_gb <= size_budget)
+    ]
+    if not fitting:
+        return None
+    return min(fitting, key=lambda e: (e.estimated_gb, e.estimated_hours))
+
+
+def print_estimates(estimates: list[ProfileEstimate]) -> None:
+    print(f"{'preset':<10} {'quality':>7} {'fps':>8} {'x realtime':>10} {'hours':>8} {'GB':>8} {'saved %':>8}")
+    for e in estimates:
+        print(f'{e.preset:<10} {e.quality:>7} {e.encode_fps:>8} {e.realtime_factor:>10} {e.estimated_hours:>8} '
+              f'{e.estimated_gb:>8} {e.saved_percent:>8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import argparse
+import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+
+from tqdm import tqdm
+
+from convert_video import METADATA_ARGS, creation_time_args, is_video_file, probe_tags, temp_path_for
+from file_metrics import MetricsRecorder, add_metrics_arguments
+
+# Tags written by the muxer/encoder itself, they are expected to differ between source and converted file
+IGNORED_TAGS = {'encoder', 'major_brand', 'minor_version', 'compatible_brands', 'handler_name', 'vendor_id'}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Copy metadata from source videos to videos converted by convert_video.py. '
+                    'Only files whose tags differ are remuxed, streams are copied without re-encoding.')
+    parser.add_argument('--src_path', '-s', type=Path, required=True,
+                        help='Path to the source directory containing original video files.')
+    parser.add_argument('--dst_path', '-d', type=Path, required=True,
+                        help='Path to the directory with converted videos (same layout, .mp4 suffix).')
+    parser.add_argument('--workers', '-w', type=int, default=os.cpu_count(),
+                        help='Number of files processed in parallel.')
+    parser.add_argument('--dry_run', '-n', action='store_true', help='Only report files with differing tags.')
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    assert args.src_path.is_dir(), f'src_path is not a directory: {args.src_path.resolve()}'
+    assert args.dst_path.is_dir(), f'dst_path is not a directory: {args.dst_path.resolve()}'
+
+    with MetricsRecorder.from_args('repair_video_metadata', args) as recorder:
+        with recorder.stage('scan'):
+            files = [file for file in args.src_path.rglob('*') if file.is_file() and is_video_file(file)]
+
+        repair = partial(repair_file, src_path=args.src_path, dst_path=args.dst_path, dry_run=args.dry_run,
+                         recorder=recorder)
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            repaired = sum(tqdm(executor.map(repair, files), total=len(files), desc='Repairing metadata'))
+
+    print(f'Files with differing metadata: {repaired} of {len(files)}')
+
+
+def differing_tags(src_tags: dict[str, str], dst_tags: dict[str, str]) -> dict[str, tuple[str, str | None]]:
+    return {
+        key: (value, dst_tags.get(key))
+        for key, value in src_tags.items()
+        if key not in IGNORED_TAGS and dst_tags.get(key) != value
+    }
+
+
+def remux_with_metadata(src_file: Path, dst_file: Path, creation_args: list[str]) -> None:
+    """Stream copy dst_file with tags of src_file into a temp file and atomically replace dst_file with it"""
+    tmp_file = temp_path_for(dst_file)
+    call_args = [
+        'ffmpeg', '-v', 'error', '-i', str(src_file), '-i', str(dst_file), '-map', '1', '-c', 'copy',
+        *METADATA_ARGS, *creation_args, str(tmp_file), '-y'
+    ]
+    try:
+        subprocess.run(call_args, capture_output=True, text=True, check=True)
+        shutil.copystat(src_file, tmp_file, follow_symlinks=True)
+        os.replace(tmp_file, dst_file)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+
+
+def repair_file(file: Path, src_path: Path, dst_path: Path, dry_run: bool, recorder: MetricsRecorder) -> bool:
+    """Returns True when the converted file had differing metadata"""
+    dst_file = dst_path / file.relative_to(src_path).with_suffix('.mp4')
+    with recorder.file(dst_file) as record:
+        if not dst_file.exists():
+            print(f'Skipping file: {file} - {dst_file} does not exist')
+            record.skipped = True
+            return False
+
+        try:
+            with record.stage('probe'):
+                src_tags = probe_tags(file)
+                dst_tags = probe_tags(dst_file)
+            diff = differing_tags(src_tags, dst_tags)
+            creation_args = creation_time_args(file, src_tags) if 'creation_time' not in dst_tags else []
+            if not diff and not creation_args:
+                record.skipped = True
+                return False
+
+            record.extra['differing_tags'] = sorted(diff) + (['creation_time'] if creation_args else [])
+            print(f'{dst_file}: differing tags {record.extra["differing_tags"]}')
+            if not dry_run:
+                record.bytes_in = dst_file.stat().st_size
+                with record.stage('remux'):
+                    remux_with_metadata(file, dst_file, creation_args)
+                record.bytes_out = dst_file.stat().st_size
+            return True
+        except subprocess.CalledProcessError as e:
+            print(f'Failed to process {file}: {e.stderr}')
+            record.error = f'{e.cmd[0]} exited with {e.returncode}: {e.stderr}'
+            return False
+        except (OSError, ValueError) as e:  # ffprobe/ffmpeg missing, file removed mid-run, unparsable probe output
+            print(f'Failed to process {file}: {e}')
+            record.error = f'{type(e).__name__}: {e}'
+            return False
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+import argparse
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+
+from convert_images import convert_image, is_image
+from convert_video import VIDEO_PRESET, VIDEO_QUALITY, convert_video, is_video_file
+from file_metrics import FileRecord, MetricsRecorder, add_metrics_arguments
+from files_integrity_check import check_image, check_video
+from find_similar_images import SUPPORTED_EXTENSIONS, ImageIndexEntry, hash_image, load_hash_index, save_hash_index
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # Without watchdog the directory is polled
+    FileSystemEventHandler = object
+    Observer = None
+
+
+class Debouncer:
+    """
+    Collects paths of changed files and releases each one when it has not changed for `delay` seconds
+    and its size stayed the same, so files still being synced or copied are not picked up half written.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._pending: dict[Path, tuple[float, int]] = {}
+        self._lock = threading.Lock()
+
+    def touch(self, path: Path) -> None:
+        if path.name.startswith('.'):  # Hidden and temporary files, e.g. partial syncs or our own temp outputs
+            return
+        with self._lock:
+            self._pending[path] = (time.monotonic(), -1)
+
+    def pop_ready(self) -> list[Path]:
+        now = time.monotonic()
+        ready = []
+        with self._lock:
+            for path, (last_event, last_size) in list(self._pending.items()):
+                if now - last_event < self.delay:
+                    continue
+                try:
+                    size = path.stat().st_size
+                except OSError:  # Removed or renamed before it settled
+                    del self._pending[path]
+                    continue
+                if size != last_size:
+                    self._pending[path] = (now, size)
+                    continue
+                del self._pending[path]
+                ready.append(path)
+        return ready
+
+
+class ChangeHandler(FileSystemEventHandler):
+    def __init__(self, debouncer: Debouncer):
+        super().__init__()
+        self.debouncer = debouncer
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.debouncer.touch(Path(event.src_path))
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.debouncer.touch(Path(event.src_path))
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.debouncer.touch(Path(event.dest_path))
+
+
+def poll_directory(directory: Path, debouncer: Debouncer, interval: float, stop: threading.Event) -> None:
+    """Fallback when inotify (watchdog) is not available, compares size and mtime snapshots of the tree"""
+    previous = snapshot(directory)
+    while not stop.wait(interval):
+        current = snapshot(directory)
+        for path, stat in current.items():
+            if previous.get(path) != stat:
+                debouncer.touch(path)
+        previous = current
+
+
+def snapshot(directory: Path) -> dict[Path, tuple[int, int]]:
+    result = {}
+    for path in directory.rglob('*'):
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        if path.is_file():
+            result[path] = (stat.st_size, stat.st_mtime_ns)
+    return result
+
+
+def unprocessed_files(input_dir: Path, output_dir: Path, codec: str) -> list[Path]:
+    """
+    Files added or modified while the watcher was not running, including those still debouncing when it stopped.
+    Outputs get the mtime of their source (copystat), so a missing output or one older than its source is stale.
+    """
+    result = []
+    for path in input_dir.rglob('*'):
+        if path.name.startswith('.') or not path.is_file():
+            continue
+        relative_path = path.relative_to(input_dir)
+        outputs = (output_dir / relative_path.with_suffix(f'.{codec}'), output_dir / relative_path.with_suffix('.mp4'))
+        try:
+            mtime = path.stat().st_mtime_ns
+            if not any(out.exists() and out.stat().st_mtime_ns >= mtime for out in outputs):
+                result.append(path)
+        except OSError:  # Removed while scanning
+            continue
+    return result
+
+
+def dispatch(debouncer: Debouncer, work_queue: queue.Queue, stop: threading.Event) -> None:
+    # put() blocks when the queue is full, so a burst of new files waits here instead of piling up in memory
+    while not stop.wait(debouncer.delay / 4):
+        for path in debouncer.pop_ready():
+            work_queue.put(path)
+
+
+class Pipeline:
+    """Integrity check, conversion and hash index update of a single new or modified file"""
+
+    def __init__(self, args: argparse.Namespace, recorder: MetricsRecorder):
+        self.args = args
+        self.recorder = recorder
+        self.video_args = argparse.Namespace(quality=args.video_quality, preset=args.video_preset)
+        self.hash_index: dict[Path, ImageIndexEntry] = {}
+        self._index_lock = threading.Lock()
+        self._index_dirty = False
+        if args.hash_index is not None:
+            self.hash_index = load_hash_index(args.hash_index, args.hash_size)
+
+    def process(self, path: Path) -> None:
+        args = self.args
+        with self.recorder.file(path) as record:
+            with record.stage('sniff'):
+                image = is_image(path)
+                video = not image and is_video_file(path)
+            if not image and not video:
+                record.skipped = True
+                return
+
+            with record.stage('verify'):
+                record.error = check_image(path) if image else check_video(path)
+            if record.error:
+                return
+
+            if image:
+                convert_image(path, args.input_dir, args.output_dir, args, record)
+            elif not convert_video(path, args.input_dir, args.output_dir, self.video_args, record):
+                return
+
+            if image and args.hash_index is not None and path.suffix.lower() in SUPPORTED_EXTENSIONS:
+                self.update_hash_index(path, record)
+
+    def update_hash_index(self, path: Path, record: FileRecord) -> None:
+        # Runs in this process, worker_profiling would start a second profiler next to the recorder's one
+        img_path, entry, hash_record = hash_image((path, self.args.hash_size, None))
+        # The file is already counted by process(), only its hashing stages are added
+        for name, seconds in hash_record.stages.items():
+            record.stages[name] = record.stages.get(name, 0.0) + seconds
+        record.error = record.error or hash_record.error
+        if entry is not None:
+            with self._index_lock:
+                self.hash_index[img_path] = entry
+                self._index_dirty = True
+
+    def save_hash_index(self) -> None:
+        with self._index_lock:
+            if self._index_dirty:
+                save_hash_index(self.hash_index, self.args.hash_index)
+                self._index_dirty = False
+
+
+def worker(pipeline: Pipeline, work_queue: queue.Queue) -> None:
+    while (path := work_queue.get()) is not None:
+        try:
+            pipeline.process(path)
+        except Exception as e:
+            print(f'Failed to process {path}: {e}')
+        finally:
+            work_queue.task_done()
+        # Save the index and metrics once the burst of files is processed rather than after every file
+        if work_queue.unfinished_tasks == 0:
+            pipeline.save_hash_index()
+            pipeline.recorder.flush()
+    work_queue.task_done()
+
+
+def main():
+    args = parse_arguments()
+    assert args.input_dir.is_dir(), f'input_dir is not directory: {args.input_dir.resolve()}'
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    stop = threading.Event()
+    debouncer = Debouncer(args.debounce)
+    work_queue = queue.Queue(maxsize=args.queue_size)
+
+    with MetricsRecorder.from_args('watch_directory', args) as recorder:
+        pipeline = Pipeline(args, recorder)
+        workers = [
+            threading.Thread(target=worker, args=(pipeline, work_queue), daemon=True) for _ in range(args.workers)
+        ]
+        for thread in workers:
+            thread.start()
+        threading.Thread(target=dispatch, args=(debouncer, work_queue, stop), daemon=True).start()
+
+        observer = None
+        if Observer is not None and not args.force_polling:
+            observer = Observer()
+            observer.schedule(ChangeHandler(debouncer), str(args.input_dir), recursive=True)
+            observer.start()
+            print(f'Watching {args.input_dir} for changes')
+        else:
+            threading.Thread(
+                target=poll_directory, args=(args.input_dir, debouncer, args.poll_interval, stop), daemon=True
+            ).start()
+            print(f'Polling {args.input_dir} every {args.poll_interval} s')
+
+        # Catch up with changes made while not running. The watch is already started, so files added during
+        # the scan are not missed, files seen by both go through the debouncer only once
+        missed = unprocessed_files(args.input_dir, args.output_dir, args.codec)
+        for path in missed:
+            debouncer.touch(path)
+        print(f'Found {len(missed)} files added or modified while not watching')
+
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print('Stopping, waiting for queued files to finish')
+        finally:
+            stop.set()
+            if observer is not None:
+                observer.stop()
+                observer.join()
+            for _ in workers:
+                work_queue.put(None)
+            for thread in workers:
+                thread.join()
+            pipeline.save_hash_index()
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Watch a directory and pass only new or modified files through integrity check, conversion '
+                    'and hash index update. Uses inotify through watchdog, or polling when it is not installed.')
+    parser.add_argument('--input_dir', '-i', help='Directory to watch', type=Path, required=True)
+    parser.add_argument('--output_dir', '-o', help='Path to the output directory', type=Path, required=True)
+    parser.add_argument('--codec', '-c', help='Image codec heif or avif', default='heif', type=str,
+                        choices=['heif', 'avif'])
+    parser.add_argument(
+        '--quality', '-q', help='Image codec quality setting [0-100]', default=50, type=int, choices=list(range(101))
+    )
+    target_group = parser.add_mutually_exclusive_group()
+    target_group.add_argument('--target_psnr', '-tp', help='Target PSNR [dB] of images, see convert_images.py',
+                              default=None, type=float)
+    target_group.add_argument('--target_ssim', '-ts', help='Target SSIM [0-1] of images, see convert_images.py',
+                              default=None, type=float)
+    parser.add_argument('--probe_size', '-ps', help='Longest side of the quality search probe', default=512, type=int)
+    parser.add_argument('--video_quality', '-vq', help='Value of ffmpeg -global_quality for videos',
+                        default=VIDEO_QUALITY, type=int)
+    parser.add_argument('--video_preset', '-vp', help='Encoder preset for videos', default=VIDEO_PRESET, type=str)
+    parser.add_argument('--hash_index', '-hi', help='Pickled hash index to keep up to date, '
+                                                    'usable with find_similar_images.py --reuse_index',
+                        type=Path, default=None)
+    parser.add_argument('--hash_size', '-hs', help='Hash size for perceptual hashing.', type=int, default=16)
+    parser.add_argument('--debounce', '-db', help='Seconds a file must stay unchanged before processing',
+                        type=float, default=5.0)
+    parser.add_argument('--queue_size', '-qs', help='Maximum number of files waiting for a worker', type=int,
+                        default=64)
+    parser.add_argument('--workers', '-w', help='Number of files processed in parallel', type=int,
+                        default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument('--poll_interval', '-pi', help='Seconds between scans in polling mode', type=float,
+                        default=30.0)
+    parser.add_argument('--force_polling', action='store_true', help='Poll even if watchdog is installed, '
+                                                                     'e.g. for network shares without inotify')
+    add_metrics_arguments(parser)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()